@@ -0,0 +1,80 @@
+"""
+Microbenchmark of the Python-side cost of the hot read statements.
+
+Compares the statements built on every call, as the handlers used to do,
+with the prebuilt statements of database.db. Does not connect to the database:
+it measures what SQLAlchemy does per call before a cached compiled statement
+is sent to the driver, i.e. building the statement and computing its cache key.
+
+Usage:
+    python benchmark_statements.py [--number 20000]
+"""
+
+import argparse
+import timeit
+from sqlalchemy import select, func
+from sqlalchemy.dialects import postgresql
+from database.models import User, SellLog
+from database.db import USER_DATA, USER_PROFILE, SELL_LOG_COUNT, CATALOG_LOT_INFO, STOCK
+
+
+TELEGRAM_ID = 123456789
+LOT_TYPE = 'example'
+
+# (name, statement built per call, prebuilt statement)
+CASES = [
+    (
+        'get_user',
+        lambda: select(
+            User.name, User.username, User.balance, User.language, User.is_ban
+        ).filter_by(telegram_id=TELEGRAM_ID),
+        USER_DATA
+    ),
+    (
+        'get_balance_and_registration',
+        lambda: select(
+            User.username, User.balance, User.registration_date, User.purchase_count
+        ).filter_by(telegram_id=TELEGRAM_ID),
+        USER_PROFILE
+    ),
+    (
+        'count_rows',
+        lambda: select(func.count()).select_from(SellLog).filter(SellLog.telegram_id == TELEGRAM_ID),
+        SELL_LOG_COUNT
+    ),
+    (
+        'get_lot_info',
+        lambda: select(STOCK.c.price, func.sum(STOCK.c.quantity).label('quantity'))
+        .filter(STOCK.c.lot_type == LOT_TYPE)
+        .group_by(STOCK.c.price)
+        .having(func.sum(STOCK.c.quantity) > 0)
+        .order_by(STOCK.c.price),
+        CATALOG_LOT_INFO
+    ),
+]
+
+
+def per_call(function, number: int) -> float:
+    """
+    Returns the best time of a call in microseconds.
+    """
+    return min(timeit.repeat(function, number=number, repeat=5)) / number * 1_000_000
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--number', type=int, default=20000, help='Calls per measurement')
+    args = parser.parse_args()
+
+    dialect = postgresql.asyncpg.dialect()
+    print(f"{'query':<30}{'per call, us':>14}{'prebuilt, us':>14}{'compile, us':>14}")
+    for name, build, prebuilt in CASES:
+        rebuilt = per_call(lambda: build()._generate_cache_key(), args.number)
+        cached = per_call(prebuilt._generate_cache_key, args.number)
+        # Compiling is what the SQLAlchemy cache saves on every call after the first one
+        compiled = per_call(lambda: prebuilt.compile(dialect=dialect), args.number // 10)
+        print(f"{name:<30}{rebuilt:>14.1f}{cached:>14.1f}{compiled:>14.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -2,13 +2,264 @@
 This module contains classes for working with the database.
 """
 
-from datetime import datetime
+import asyncio
+from datetime import datetime, timedelta
 from decimal import Decimal
-from sqlalchemy import func
-from sqlalchemy.exc import SQLAlchemyError, IntegrityError, NoResultFound
+from sqlalchemy import func, select, exists, delete, update, or_, values, column, bindparam, union_all, Update
+from sqlalchemy import Boolean, BigInteger, DateTime, String, literal_column
+from sqlalchemy.exc import SQLAlchemyError, IntegrityError
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import undefer
 from aiogram.types import Message, CallbackQuery
 from utils.logs import log
-from database.models import User, SellLog, Account,tz, session
+from utils.cache import CatalogCache
+from env import Config as config
+from database.models import User, SellLog, Account, InventorySummary, InventoryDelta, session_scope, read_scope
+from database.models import mark_written, hash_content, local_now
+
+
+catalog_cache = CatalogCache(ttl=float(config.catalog_cache_ttl))
+
+# Replica routing key of all catalog reads, see read_scope
+CATALOG_KEY = 'catalog'
+
+
+def user_key(telegram_id: int | str) -> tuple[str, int]:
+    """
+    Returns the replica routing key of the reads of a user's profile and sell log.
+    """
+    return ('user', int(telegram_id))
+
+
+def invalidate_catalog(lot_type: str) -> None:
+    """
+    Drops the cached catalog entries affected by a change of stock or price of a lot type.
+    The next loads read the primary, so they do not cache a lagging replica.
+    """
+    mark_written(CATALOG_KEY)
+    catalog_cache.invalidate(
+        'description_main', 'lot_type', ('lot_info', lot_type), ('lot_details', lot_type))
+
+
+# Statements of the hot read paths, built once at import. Values are passed as
+# bound parameters, so every call reuses the same cache key and compiled SQL,
+# and asyncpg reuses the prepared statement of the connection.
+USER_DATA = select(
+    User.name, User.username, User.balance, User.language, User.is_ban
+).filter(User.telegram_id == bindparam('telegram_id'))
+USER_BALANCE = select(User.username, User.balance).filter(User.telegram_id == bindparam('telegram_id'))
+USER_LANGUAGE = select(User.language).filter(User.telegram_id == bindparam('telegram_id'))
+USER_IS_BAN = select(User.is_ban).filter(User.telegram_id == bindparam('telegram_id'))
+USER_PROFILE = select(
+    User.username, User.balance, User.registration_date, User.purchase_count
+).filter(User.telegram_id == bindparam('telegram_id'))
+SELL_LOG_COUNT = select(func.count()).select_from(SellLog).filter(
+    SellLog.telegram_id == bindparam('telegram_id'))
+SELL_LOG_EXISTS = select(exists().where(SellLog.filename == bindparam('filename')))
+# Stock per lot type and price: the compacted summary plus the deltas not compacted yet.
+# Filters on lot_type are pushed down into both parts of the union.
+STOCK = union_all(
+    select(InventorySummary.lot_type, InventorySummary.price, InventorySummary.quantity),
+    select(InventoryDelta.lot_type, InventoryDelta.price, InventoryDelta.quantity)
+).subquery('stock')
+STOCK_QUANTITY = func.sum(STOCK.c.quantity)
+CATALOG_DESCRIPTION = select(
+    STOCK.c.lot_type, STOCK.c.price, STOCK_QUANTITY.label('quantity')
+).group_by(STOCK.c.lot_type, STOCK.c.price).having(STOCK_QUANTITY > 0).order_by(
+    STOCK.c.lot_type, STOCK.c.price)
+CATALOG_LOT_TYPES = select(STOCK.c.lot_type).group_by(STOCK.c.lot_type).having(
+    STOCK_QUANTITY > 0).order_by(STOCK.c.lot_type)
+CATALOG_LOT_INFO = select(
+    STOCK.c.price, STOCK_QUANTITY.label('quantity')
+).filter(STOCK.c.lot_type == bindparam('lot_type')).group_by(STOCK.c.price).having(
+    STOCK_QUANTITY > 0).order_by(STOCK.c.price)
+CATALOG_LOT_DETAILS = select(
+    STOCK.c.lot_type, STOCK.c.price, STOCK_QUANTITY.label('quantity')
+).filter(STOCK.c.lot_type == bindparam('lot_type')).group_by(STOCK.c.lot_type, STOCK.c.price).having(
+    STOCK_QUANTITY > 0).order_by(STOCK.c.price)
+INVENTORY_COMPACT = select(func.inventory_summary_compact())
+
+
+class ActivityBuffer:
+    """
+    Write-behind buffer for user activity. Coalesces last_visit and username
+    updates per telegram_id and writes them every few seconds with one
+    UPDATE ... FROM (VALUES ...) statement per chunk.
+
+    Args:
+        interval (float): Seconds between flushes.
+        chunk_size (int, optional): Users per statement. Defaults to 1000.
+    """
+    def __init__(self, interval: float, chunk_size: int = 1000) -> None:
+        self.interval = interval
+        self.chunk_size = chunk_size
+        self.pending: dict[int, tuple[datetime, str | None]] = {}
+        self.task: asyncio.Task | None = None
+
+    def touch(self, telegram_id: int, username: str | None) -> None:
+        """
+        Records a visit of the user. Only the latest visit per user is kept.
+        """
+        self.pending[telegram_id] = (local_now(), username)
+
+    async def flush(self) -> int:
+        """
+        Writes all buffered visits to the database.
+        If the write fails, the visits are put back unless newer ones arrived.
+
+        Returns:
+            int: Number of users written.
+        """
+        if not self.pending:
+            return 0
+
+        pending, self.pending = self.pending, {}
+        rows = list(pending.items())
+        try:
+            async with session_scope() as session:
+                for start in range(0, len(rows), self.chunk_size):
+                    activity = values(
+                        column('telegram_id', BigInteger),
+                        column('last_visit', DateTime),
+                        column('username', String),
+                        name='activity'
+                    ).data([
+                        (telegram_id, last_visit, username)
+                        for telegram_id, (last_visit, username) in rows[start:start + self.chunk_size]
+                    ])
+                    await session.execute(
+                        update(User)
+                        .filter(User.telegram_id == activity.c.telegram_id)
+                        .values(last_visit=activity.c.last_visit, username=activity.c.username),
+                        execution_options={'synchronize_session': False}
+                    )
+                await session.commit()
+        except Exception as e:
+            for telegram_id, visit in pending.items():
+                self.pending.setdefault(telegram_id, visit)
+            log.error(f"Failed to flush activity of {len(pending)} users: {e}")
+            return 0
+
+        return len(rows)
+
+    async def run(self) -> None:
+        """
+        Flushes the buffer every interval seconds until cancelled.
+        """
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                log.error(f"Activity flush failed: {e}")
+
+    def start(self) -> None:
+        """
+        Starts the periodic flush in the background.
+        """
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        """
+        Stops the periodic flush and writes what is left in the buffer.
+        """
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        written = await self.flush()
+        log.info(f"Activity buffer stopped. Flushed {written} users")
+
+
+activity_buffer = ActivityBuffer(interval=float(config.activity_flush_interval))
+
+
+class InventoryCompactor:
+    """
+    Folds the inventory deltas appended by the triggers on accounts into the
+    summary every few seconds, so the catalog reads only add up a few recent deltas.
+    Instances of the bot skip a round while another one is compacting.
+
+    Args:
+        interval (float): Seconds between compactions.
+    """
+    def __init__(self, interval: float) -> None:
+        self.interval = interval
+        self.task: asyncio.Task | None = None
+
+    async def compact(self) -> int:
+        """
+        Folds the pending deltas into the summary in one transaction.
+
+        Returns:
+            int: Number of summary rows changed.
+        """
+        async with session_scope() as session:
+            compacted = (await session.execute(INVENTORY_COMPACT)).scalar_one()
+            await session.commit()
+        return compacted
+
+    async def run(self) -> None:
+        """
+        Compacts every interval seconds until cancelled.
+        """
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.compact()
+            except Exception as e:
+                log.error(f"Inventory compaction failed: {e}")
+
+    def start(self) -> None:
+        """
+        Starts the periodic compaction in the background.
+        """
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        """
+        Stops the periodic compaction.
+        """
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+
+inventory_compactor = InventoryCompactor(interval=float(config.inventory_compact_interval))
+
+
+def balance_update(condition, delta: Decimal, non_negative: bool = False, **values) -> Update:
+    """
+    Builds UPDATE users SET balance = balance + :delta WHERE ... RETURNING balance,
+    so balance changes are a single statement and concurrent changes never get lost.
+
+    Args:
+        condition: Filter selecting the user.
+        delta (Decimal): Amount to add, negative for a debit.
+        non_negative (bool, optional): If True, the row is only updated when the
+            balance stays non-negative. Defaults to False.
+        **values: Other columns to update in the same statement.
+
+    Returns:
+        Update: The statement. It returns no row if the user was not found
+        or the guard did not pass.
+    """
+    statement = (
+        update(User)
+        .filter(condition)
+        .values(balance=User.balance + delta, **values)
+        .returning(User.balance)
+    )
+    if non_negative:
+        statement = statement.filter(User.balance + delta >= 0)
+    return statement
 
 
 class Telegram:
@@ -40,30 +291,18 @@ class UserDb(Telegram):
     """
     def __init__(self) -> None:
         self.user = User
-        self.session = session
+        self.session = session_scope
         self.telegram = Telegram()
 
-    def refresh_user(self, user: User, obj: Message|CallbackQuery) -> None:
+    def refresh_user(self, obj: Message|CallbackQuery) -> None:
         """
-        Refreshes the last visit parameter of the user in the database.
-        Checks the username and changes it if it is different from the one in the database.
+        Refreshes the last visit parameter and the username of the user.
+        The change is buffered and written in a batch by the activity buffer.
         """
         telegram = self.telegram.data(obj)
-        # Refresh last visit parameter
-        user.last_visit = datetime.now(tz)
-        log.info(
-            f"ID: {telegram.telegram_id} | Username: {telegram.username} "
-            f"Changed username in the database. Old: {user.username}"
-        )
-        # Check username. If it is different, change it
-        if user.username != telegram.username:
-            log.info(
-                f'ID: {telegram.telegram_id}| Username: {telegram.username}| '
-                f'Changed username in the database. Old: {user.username}'
-                )
-            user.username = self.username
+        activity_buffer.touch(telegram_id=telegram.telegram_id, username=telegram.username)
 
-    def get_user(self, obj: Message|CallbackQuery) -> dict|None:
+    async def get_user(self, obj: Message|CallbackQuery) -> dict|None:
         """
         Retrieves user data from the database.
 
@@ -79,18 +318,12 @@ class UserDb(Telegram):
         """
         telegram = self.telegram.data(obj)
 
-        with self.session:
-            user = self.session.query(User).filter_by(telegram_id=telegram.telegram_id).first()
+        async with self.session() as session:
+            user = (await session.execute(USER_DATA, {'telegram_id': telegram.telegram_id})).first()
             if user:
-                self.refresh_user(user=user, obj=obj)
-
-                data = {
-                    'name': user.name,
-                    'username': user.username,
-                    'balance': user.balance,
-                    'language': user.language,
-                    'is_ban': user.is_ban
-                }
+                self.refresh_user(obj=obj)
+
+                data = dict(user._mapping)
                 log.info(
                     f'ID: {telegram.telegram_id}| Username: {telegram.username}| '
                     f'Data: {data}| Was already in the database'
@@ -104,7 +337,57 @@ class UserDb(Telegram):
                     )
                 return {}
 
-    def create_user(self, obj: Message|CallbackQuery, language: str = 'RUS') -> None:
+    async def upsert_user(self, obj: Message|CallbackQuery, language: str = 'RUS') -> dict:
+        """
+        Creates the user or refreshes their last visit and username
+        with a single INSERT ... ON CONFLICT DO UPDATE ... RETURNING statement.
+
+        Args:
+            obj (Message|CallbackQuery): Telegram object with user data
+            language (str, optional): Language of a new user. Defaults to 'RUS'.
+
+        Returns:
+            dict: User data and 'is_new', True if the user was just created.
+        """
+        telegram = self.telegram.data(obj)
+        telegram_id, username = telegram.telegram_id, telegram.username
+        now = local_now()
+
+        statement = insert(User).values(
+            telegram_id=telegram_id,
+            name=telegram.name,
+            username=username,
+            balance=0,
+            language=language,
+            last_visit=now,
+            registration_date=now
+        )
+        statement = statement.on_conflict_do_update(
+            index_elements=[User.telegram_id],
+            set_={
+                'last_visit': statement.excluded.last_visit,
+                'username': statement.excluded.username
+            }
+        ).returning(
+            User.name,
+            User.username,
+            User.balance,
+            User.language,
+            User.is_ban,
+            # xmax is 0 only for rows inserted by this statement
+            literal_column('users.xmax = 0', Boolean).label('is_new')
+        )
+
+        async with self.session() as session:
+            user = (await session.execute(statement)).one()
+            await session.commit()
+        mark_written(user_key(telegram_id))
+
+        data = dict(user._mapping)
+        log.info(f'ID: {telegram_id}| Username: {username}| Upserted user: {data}')
+        return data
+
+    async def create_user(self, obj: Message|CallbackQuery, language: str = 'RUS') -> None:
         """
         Creates a new user in the database.
         
@@ -114,75 +397,91 @@ class UserDb(Telegram):
         """
         telegram = self.telegram.data(obj)
 
-        with self.session:
+        async with self.session() as session:
             new_user = User(
                 telegram_id= telegram.telegram_id,
                 name= telegram.name,
                 username= telegram.username,
                 balance= 0,
                 language= language,
-                last_visit= datetime.now(tz)
+                last_visit= local_now()
             )
-            self.session.add(new_user)
+            session.add(new_user)
             log.info(
                 f'ID: {telegram.telegram_id}| Username: '
                 f'{telegram.username}| Added to the database'
                 )
-            self.session.commit()
+            await session.commit()
+        mark_written(user_key(telegram.telegram_id))
 
-    def topup_balance(self, obj: Message|CallbackQuery, topup_quantity: float) -> bool:
+    async def topup_balance(
+            self,
+            obj: Message|CallbackQuery,
+            topup_quantity: float,
+            non_negative: bool = False
+        ) -> bool:
         """
-        Adds money to user's balance.
+        Adds money to user's balance in a single UPDATE ... RETURNING statement.
         
         Args:
-            new_balance (str): Amount of money to add to the balance.
+            obj (Message|CallbackQuery): Telegram object with user data
+            topup_quantity (float): Amount of money to add, negative for a debit.
+            non_negative (bool, optional): If True, the balance is only changed
+                when it stays non-negative. Defaults to False.
         
         Returns:
             bool: True if the user was found and their balance was updated, False otherwise.
         """
         telegram = self.telegram.data(obj)
+        telegram_id, username = telegram.telegram_id, telegram.username
+
+        async with self.session() as session:
+            balance = await session.scalar(
+                balance_update(
+                    User.telegram_id == telegram_id,
+                    delta=Decimal(str(topup_quantity)),
+                    non_negative=non_negative
+                ),
+                execution_options={'synchronize_session': False}
+            )
+            await session.commit()
+        mark_written(user_key(telegram_id))
 
-        with self.session:
-            user = self.session.query(User).filter_by(telegram_id=telegram.telegram_id).first()
-            if user:
-                user.balance += Decimal(str(topup_quantity))
-                self.session.commit()
-                log.info(
-                    f'ID: {telegram.telegram_id}| Username: {telegram.username}| '
-                    f'Top up balance to {topup_quantity}'
-                    )
-                return True
-            else:
-                log.error(
-                    f'ID: {telegram.telegram_id}| Username: {telegram.username}| User not found')
-                return False
+        if balance is None:
+            log.error(f'ID: {telegram_id}| Username: {username}| Balance was not changed')
+            return False
+
+        log.info(
+            f'ID: {telegram_id}| Username: {username}| '
+            f'Top up balance to {topup_quantity}. Balance: {balance}'
+            )
+        return True
 
-    def get_balance(self) -> str|None:
+    async def get_balance(self, obj: Message|CallbackQuery) -> str|None:
         """
         Retrieves user's balance.
         
         Args:
-            None
+            obj (Message|CallbackQuery): Telegram object with user data
         
         Returns:
             str|None: User's balance if found, else None
         """
-        with self.session:
-            user = self.session.query(User).filter_by(telegram_id=self.telegram.telegram_id).first()
+        telegram_id = self.telegram.data(obj).telegram_id
+
+        async with self.session() as session:
+            user = (await session.execute(USER_BALANCE, {'telegram_id': telegram_id})).first()
             if user:
                 balance = user.balance
                 log.info(
-                    f'ID: {self.telegram.telegram_id}| '
-                    f'Username: {self.telegram.username}| Balance: {balance}'
+                    f'ID: {telegram_id}| '
+                    f'Username: {user.username}| Balance: {balance}'
                 )
                 return balance
             else:
-                log.error(
-                    f'ID: {self.telegram.telegram_id}| '
-                    f'Username: {self.telegram.username}| User not found'
-                )
+                log.error(f'ID: {telegram_id}| User not found')
 
-    def change_user_language(self, new_language: str) -> bool:
+    async def change_user_language(self, new_language: str) -> bool:
         """
         Changes user's language.
 
@@ -192,11 +491,11 @@ class UserDb(Telegram):
         Returns:
             bool: True if the user was found and their language was updated, False otherwise.
         """
-        with self.session:
-            user = self.session.query(User).filter(User.telegram_id == self.telegram_id).first()
+        async with self.session() as session:
+            user = await session.scalar(select(User).filter_by(telegram_id=self.telegram_id))
             if user:
                 user.language = new_language
-                self.session.commit()
+                await session.commit()
                 log.info(
                     f'ID: {self.telegram_id}| Username: {self.username}| '
                     f'Changed language in the database'
@@ -206,7 +505,7 @@ class UserDb(Telegram):
                 log.error(f'ID: {self.telegram_id}| Username: {self.username}| User not found')
                 return False
 
-    def get_user_language(self) -> str|None:
+    async def get_user_language(self) -> str|None:
         """
         Retrieves user's language.
         
@@ -216,8 +515,8 @@ class UserDb(Telegram):
         Returns:
             str|None: User's language if found, else None
         """
-        with self.session:
-            user = self.session.query(User).filter_by(telegram_id=self.telegram_id).first()
+        async with self.session() as session:
+            user = (await session.execute(USER_LANGUAGE, {'telegram_id': self.telegram_id})).first()
             if user:
                 log.info(
                     f'ID: {self.telegram_id}| Username: {self.username}| '
@@ -229,7 +528,7 @@ class UserDb(Telegram):
                 return None
 
 
-    def get_banned_users(self) -> list:
+    async def get_banned_users(self) -> list:
         """
         Retrieves a list of banned users from the database.
 
@@ -238,8 +537,8 @@ class UserDb(Telegram):
             for each banned user. If no users are banned, returns "No users are banned".
         """
 
-        with self.session:
-            banned_users = self.session.query(User).filter(User.is_ban is True).all()
+        async with self.session() as session:
+            banned_users = (await session.scalars(select(User).filter(User.is_ban.is_(True)))).all()
             if banned_users:
                 log.info(
                     f'ID: {self.telegram_id}| Username: '
@@ -250,7 +549,7 @@ class UserDb(Telegram):
                 log.info(f'ID: {self.telegram_id}| Username: {self.username}| No users are banned')
                 return "No users are banned"
 
-    def set_user_ban(self, telegram_id: str) -> bool:
+    async def set_user_ban(self, telegram_id: str) -> bool:
         """
         Bans a user with the specified Telegram ID.
 
@@ -260,12 +559,12 @@ class UserDb(Telegram):
         Returns:
             bool: True if the user was found and banned, False otherwise.
         """
-        with self.session:
+        async with self.session() as session:
             try:
-                user = self.session.query(User).filter_by(telegram_id=telegram_id).first()
+                user = await session.scalar(select(User).filter_by(telegram_id=telegram_id))
                 if user:
                     user.is_ban = True
-                    self.session.commit()
+                    await session.commit()
                     log.info(
                         f'ID: {self.telegram_id}| Username: {self.username}| '
                         f'User {telegram_id} was banned'
@@ -283,7 +582,7 @@ class UserDb(Telegram):
                     f'Attribute error while banning user {telegram_id}: {e}'
                     )
 
-    def set_user_unban(self, telegram_id: str) -> bool:
+    async def set_user_unban(self, telegram_id: str) -> bool:
         """
         Unbans a user with the specified Telegram ID.
 
@@ -293,12 +592,12 @@ class UserDb(Telegram):
         Returns:
             bool: True if the user was found and unbanned, False otherwise.
         """
-        with self.session:
+        async with self.session() as session:
             try:
-                user = self.session.query(User).filter_by(telegram_id=telegram_id).first()
+                user = await session.scalar(select(User).filter_by(telegram_id=telegram_id))
                 if user:
                     user.is_ban = False
-                    self.session.commit()
+                    await session.commit()
                     log.info(
                         f'ID: {self.telegram_id}| Username: {self.username}| '
                         f'User {telegram_id} was unbanned'
@@ -316,7 +615,7 @@ class UserDb(Telegram):
                     f'Attribute error while unbanning user {telegram_id}: {e}'
                     )
 
-    def check_ban(self, telegram_id: str) -> bool:
+    async def check_ban(self, telegram_id: str) -> bool:
         """
         Checks if a user with the specified Telegram ID is banned.
 
@@ -326,12 +625,10 @@ class UserDb(Telegram):
         Returns:
             bool: True if the user is banned, False otherwise.
         """
-        with self.session:
+        async with self.session() as session:
             try:
-                user = self.session.query(User).filter_by(telegram_id=telegram_id).first()
-                if user:
-                    return user.is_ban
-                return False
+                is_ban = await session.scalar(USER_IS_BAN, {'telegram_id': int(telegram_id)})
+                return bool(is_ban)
             except SQLAlchemyError as e:
                 log.error(
                     f'ID: {self.telegram_id}| Username: {self.username}| '
@@ -343,7 +640,7 @@ class UserDb(Telegram):
                     f'Error in checking ban status of user {telegram_id}: {e}'
                     )
 
-    def get_balance_and_registration(
+    async def get_balance_and_registration(
             self, obj: Message|CallbackQuery) -> tuple[float | None, datetime | None]:
         """
         Retrieves user's balance and registration date from the database.
@@ -358,20 +655,19 @@ class UserDb(Telegram):
         """
         telegram_id = self.telegram.data(obj).telegram_id
 
-        with self.session:
+        async with read_scope(user_key(telegram_id)) as session:
             try:
-                user = self.session.query(User).filter_by(telegram_id=telegram_id).first()
+                user = (await session.execute(USER_PROFILE, {'telegram_id': telegram_id})).first()
                 if user:
-                    purchase_count = len(user.sell_logs)
                     log.info(
                         f'ID: {telegram_id}| Username: {user.username}| '
                         f'Balance: {user.balance}, Registration: {user.registration_date}, '
-                        f'Purchases: {purchase_count}'
+                        f'Purchases: {user.purchase_count}'
                     )
                     return {
                         'balance': user.balance,
                         'registration_date': user.registration_date,
-                        'purchases': purchase_count
+                        'purchases': user.purchase_count
                     }
                 return None, None
             except SQLAlchemyError as e:
@@ -380,19 +676,31 @@ class UserDb(Telegram):
                 )
                 return None, None
 
-    def change_user_balance(self, username: str, change_balance: float | Decimal) -> bool:
-        with self.session:
-            try:
-                user = self.session.query(User).filter_by(username=username).one()
-            except NoResultFound:
-                log.error(f"Пользователь с username '{username}' не найден.")
-                return False
+    async def change_user_balance(self, username: str, change_balance: float | Decimal) -> bool:
+        async with self.session() as session:
+            changed = (await session.execute(
+                balance_update(User.username == username, delta=Decimal(str(change_balance)))
+                .returning(User.telegram_id),
+                execution_options={'synchronize_session': False}
+            )).all()
+            # Usernames are not unique, the change must apply to exactly one user
+            if len(changed) != 1:
+                await session.rollback()
+            else:
+                await session.commit()
+
+        if not changed:
+            log.error(f"Пользователь с username '{username}' не найден.")
+            return False
+        if len(changed) > 1:
+            log.error(f"Username '{username}' принадлежит нескольким пользователям: {len(changed)}")
+            return False
 
-            user.balance += Decimal(change_balance)
+        mark_written(user_key(changed[0].telegram_id))
+        balance = changed[0].balance
 
-            self.session.commit()
-            log.info(f"Username: {username}| Новый баланс: {user.balance}")
-            return True
+        log.info(f"Username: {username}| Новый баланс: {balance}")
+        return True
 
 
 class SelllogDb:
@@ -401,104 +709,118 @@ class SelllogDb:
     """
     def __init__(self) -> None:
         self.user = User
-        self.session = session
+        self.session = session_scope
         self.telegram = Telegram()
 
-    def count_rows(self) -> str:
+    async def count_rows(self) -> str:
         """
         Counts the number of rows in the sell log for the given user.
 
         Returns:
             str: The number of rows in the sell log.
         """
-        with self.session:
-            count = self.session.query(
-                func.count(SellLog.id)).filter(
-                    SellLog.telegram_id == self.telegram.telegram_id
-                    ).scalar()
+        async with read_scope(user_key(self.telegram.telegram_id)) as session:
+            count = await session.scalar(SELL_LOG_COUNT, {'telegram_id': self.telegram.telegram_id})
             log.info(
                 f'ID: {self.telegram.telegram_id}| Username: {self.telegram.username}| Count: {count}'
             )
             return str(count)
 
-    def sell_log(
+    async def settle_purchase(
             self,
-            folder_name: str,
-            filename: str,
-            price: float,
-            content: str,
-            obj: Message|CallbackQuery
-        ) -> None:
+            obj: Message|CallbackQuery,
+            lot_type: str,
+            ids: list[int],
+            total_price: float
+        ) -> tuple[list[dict[str, str]], list[str]]:
         """
-        Adds a sell log to the database.A
+        Settles a purchase in a single transaction: deletes the sold accounts,
+        writes their sell logs in bulk and debits the user's balance,
+        increasing the purchase counter.
+        Only lots still claimed by the user are sold. If the balance is too low
+        or any of the lots is no longer held, nothing is changed.
 
         Args:
-            folder_name (str): The type of the sell.
-            filename (str): The name of the file that was sold.
-            price (float): The price of the sell.
+            obj (Message|CallbackQuery): Telegram object with user data
+            lot_type (str): The type of the purchased lots.
+            ids (list[int]): IDs of the lots claimed by the user. The payloads are
+                loaded here, in the same statement that deletes the lots.
+            total_price (float): The amount to debit from the user's balance.
+
+        Returns:
+            tuple[list[dict[str, str]], list[str]]: Delivered lots in the
+            {'filename': ..., lot_type: txt} format and filenames whose content
+            was already in the sell log. Empty lists if the purchase was not settled.
         """
         telegram = self.telegram.data(obj)
+        telegram_id, username, name = telegram.telegram_id, telegram.username, telegram.name
+        total = Decimal(str(total_price))
 
-        with self.session:
+        async with self.session() as session:
             try:
-                sell_log = SellLog(
-                    telegram_id=telegram.telegram_id,
-                    time=datetime.now(tz),
-                    name=telegram.name,
-                    username=telegram.username,
-                    type=folder_name,
-                    filename=filename,
-                    content=content,
-                    price= price
-                )
-                self.session.add(sell_log)
-                self.session.commit()
-                log.info(
-                    f'ID: {telegram.telegram_id}| Username: {telegram.username}| '
-                    f'Added sell log to the database'
+                sold = (await session.execute(
+                    delete(Account)
+                    .filter(Account.id.in_(ids), Account.claimed_by == telegram_id)
+                    .returning(Account.filename, Account.txt, Account.price),
+                    execution_options={'synchronize_session': False}
+                )).all()
+                if not sold or len(sold) != len(set(ids)):
+                    await session.rollback()
+                    log.error(
+                        f'ID: {telegram_id}| Username: {username}| '
+                        f'Only {len(sold)} of {len(ids)} lots are available'
                     )
-            except IntegrityError as e:
-                self.session.rollback()
-                log.error(
-                    f'ID: {telegram.telegram_id}| Username: {telegram.username}| '
-                    f'Duplicate in the sell log: {e}'
+                    return [], []
+
+                now = local_now()
+                logged = set(await session.scalars(
+                    insert(SellLog).on_conflict_do_nothing().returning(SellLog.filename),
+                    [
+                        {
+                            'telegram_id': telegram_id,
+                            'time': now,
+                            'name': name,
+                            'username': username,
+                            'type': lot_type,
+                            'filename': account.filename,
+                            'content': account.txt,
+                            'price': str(account.price)
+                        }
+                        for account in sold
+                    ]
+                ))
+
+                balance = await session.scalar(
+                    balance_update(
+                        User.telegram_id == telegram_id,
+                        delta=-total,
+                        non_negative=True,
+                        purchase_count=User.purchase_count + len(logged)
+                    ),
+                    execution_options={'synchronize_session': False}
                 )
-                return filename
+                if balance is None:
+                    await session.rollback()
+                    log.error(f'ID: {telegram_id}| Username: {username}| Not enough balance for {total}')
+                    return [], []
 
-    def topup_log(
-            self, folder_name: str,
-            filename: str,
-            price: float,
-            obj: Message|CallbackQuery
-        ) -> None:
-        """
-        Adds a topup log to the database.
+                await session.commit()
+            except SQLAlchemyError as e:
+                await session.rollback()
+                log.error(f'ID: {telegram_id}| Username: {username}| Purchase was not settled: {e}')
+                return [], []
 
-        Args:
-            folder_name (str): The type of the topup.
-            filename (str): The name of the file that was topped up.
-            price (float): The price of the topup.
-        """
-        telegram = self.telegram.data(obj)
+        mark_written(user_key(telegram_id))
+        invalidate_catalog(lot_type)
 
-        with self.session:
-            sell_log = SellLog(
-                telegram_id=telegram.telegram_id,
-                time=datetime.now(tz),
-                name=telegram.name,
-                username=telegram.username,
-                type=folder_name,
-                filename=filename,
-                price= price
-            )
-            self.session.add(sell_log)
-            self.session.commit()
-            log.info(
-                f'ID: {telegram.telegram_id}| '
-                f'Username: {telegram.username}| Added topup log to the database'
-            )
+        duplicates = [account.filename for account in sold if account.filename not in logged]
+        log.info(
+            f'ID: {telegram_id}| Username: {username}| Settled purchase of {len(sold)} lots '
+            f'for {total}. Balance: {balance}. Duplicates in the sell log: {duplicates}'
+        )
+        return [{'filename': account.filename, lot_type: account.txt} for account in sold], duplicates
 
-    def exists_by_filename(self, obj: Message|CallbackQuery, filename: str) -> bool:
+    async def exists_by_filename(self, obj: Message|CallbackQuery, filename: str) -> bool:
         """
         Checks if a sell log with the given filename exists in the database.
 
@@ -509,16 +831,14 @@ class SelllogDb:
             bool: True if the filename exists, False otherwise.
         """
         telegram = self.telegram.data(obj)
-        with self.session:
-            exists = self.session.query(
-                self.session.query(SellLog).filter_by(filename=filename).exists()
-            ).scalar()
+        async with self.session() as session:
+            is_exists = await session.scalar(SELL_LOG_EXISTS, {'filename': filename})
 
         log.info(
             f'ID: {telegram.telegram_id}| Username: {telegram.username}| '
-            f'Filename "{filename}" exists: {exists}'
+            f'Filename "{filename}" exists: {is_exists}'
         )
-        return exists
+        return is_exists
 
 
 class AccountDb(Telegram):
@@ -527,10 +847,11 @@ class AccountDb(Telegram):
     """
     def __init__(self) -> None:
         self.user = User
-        self.session = session
+        self.session = session_scope
         self.telegram = Telegram()
+        self.cache = catalog_cache
 
-    def get_description_main(self) -> list[tuple[str, float, int]]:
+    async def get_description_main(self) -> list[tuple[str, float, int]]:
         """
         Gets a description of the main menu.
 
@@ -538,37 +859,28 @@ class AccountDb(Telegram):
             list[tuple[str, float, int]]: A list of tuples containing the type of the lot,
                 its price and the quantity of such lots.
         """
-        with self.session:
-            results = (
-                session.query(
-                    Account.lot_type,
-                    Account.price,
-                    func.count(Account.id).label("quantity")
-                )
-                .group_by(Account.lot_type, Account.price)
-                .order_by(Account.lot_type)
-                .all()
-            )
-        return results
+        async def load():
+            async with read_scope(CATALOG_KEY) as session:
+                results = await session.execute(CATALOG_DESCRIPTION)
+                return results.all()
 
-    def get_lot_type(self) -> list[tuple[str]]:
+        return await self.cache.get('description_main', load)
+
+    async def get_lot_type(self) -> list[str]:
         """
-        Gets a description of the main menu.
+        Gets the lot types that are in stock.
 
         Returns:
-            list[tuple[str, float, int]]: A list of tuples containing the type of the lot,
-                its price and the quantity of such lots.
+            list[str]: Lot types in alphabetical order.
         """
-        with self.session:
-            results = (
-                self.session.query(Account.lot_type)
-                .distinct()
-                .order_by(Account.lot_type)
-                .all()
-            )
-            return [row[0] for row in results]
+        async def load():
+            async with read_scope(CATALOG_KEY) as session:
+                results = await session.scalars(CATALOG_LOT_TYPES)
+                return results.all()
+
+        return await self.cache.get('lot_type', load)
 
-    def get_lot_info(self, lot_type: str) -> list[tuple[float, int]]:
+    async def get_lot_info(self, lot_type: str) -> list[tuple[float, int]]:
         """
         Retrieves price and quantity information for a specific lot type.
 
@@ -579,20 +891,14 @@ class AccountDb(Telegram):
             list[tuple[float, int]]: A list of tuples where each tuple contains the price
             of the lot and the quantity available at that price.
         """
-        with session:
-            results = (
-                session.query(
-                    Account.price,
-                    func.count(Account.id).label("quantity")
-                )
-                .filter(Account.lot_type == lot_type)
-                .group_by(Account.price)
-                .order_by(Account.price)
-                .all()
-            )
-        return results
+        async def load():
+            async with read_scope(CATALOG_KEY) as session:
+                results = await session.execute(CATALOG_LOT_INFO, {'lot_type': lot_type})
+                return results.all()
+
+        return await self.cache.get(('lot_info', lot_type), load)
 
-    def get_lot_details(self, lot_type: str) -> tuple[str, float, int]:
+    async def get_lot_details(self, lot_type: str) -> tuple[str, float, int]:
         """
         Retrieves the details of a specific lot type.
 
@@ -603,21 +909,14 @@ class AccountDb(Telegram):
             tuple[str, float, int]: A tuple containing the type of the lot, 
             its price, and the quantity available for that price.
         """
-        with session:
-            result = (
-                session.query(
-                    Account.lot_type,
-                    Account.price,
-                    func.count(Account.id).label("quantity")
-                )
-                .filter(Account.lot_type == lot_type)
-                .group_by(Account.lot_type, Account.price)
-                .order_by(Account.price)
-                .first()
-            )
-        return result
+        async def load():
+            async with read_scope(CATALOG_KEY) as session:
+                result = await session.execute(CATALOG_LOT_DETAILS, {'lot_type': lot_type})
+                return result.first()
+
+        return await self.cache.get(('lot_details', lot_type), load)
 
-    def get_lots_by_type(self, lot_type: str, quantity: int) -> list[Account]:
+    async def get_lots_by_type(self, lot_type: str, quantity: int) -> list[Account]:
         """
         Retrieves a list of Account objects for a specified lot type and quantity.
 
@@ -629,17 +928,16 @@ class AccountDb(Telegram):
             list[Account]: A list of Account objects matching the specified lot type, 
             limited to the specified quantity, and ordered by price.
         """
-        with session:
-            result = (
-                session.query(Account)
+        async with self.session() as session:
+            result = await session.scalars(
+                select(Account)
                 .filter(Account.lot_type == lot_type)
                 .order_by(Account.price)
                 .limit(quantity)
-                .all()
             )
-        return result
+            return result.all()
 
-    def get_lot_texts_by_type(self, lot_type: str, quantity: int) -> list[dict[str, str]]:
+    async def get_lot_texts_by_type(self, lot_type: str, quantity: int) -> list[dict[str, str]]:
         """
         Retrieves a list of dictionaries, where each dictionary contains the type of the lot
         as the key and the text of the lot as the value, for a specified lot type and quantity.
@@ -653,30 +951,121 @@ class AccountDb(Telegram):
             key and the text of the lot as the value, limited to the specified quantity, and
             ordered by price.
         """
-        with session:
-            lots = (
-                session.query(Account)
+        async with self.session() as session:
+            lots = await session.scalars(
+                select(Account)
+                .options(undefer(Account.txt))
                 .filter(Account.lot_type == lot_type)
                 .order_by(Account.price)
                 .limit(quantity)
-                .all()
             )
             return [{'filename': lot.filename ,lot.lot_type: lot.txt} for lot in lots]
 
-    def delete_by_filename(self, filename: str) -> None:
+    async def get_free_lots(self, lot_type: str, limit: int) -> list[dict]:
+        """
+        Retrieves the cheapest lots of a type that are not claimed, without locking them.
+        Used as candidates for a reservation, which decides which of them a buyer gets.
+
+        Args:
+            lot_type (str): The type of the lot.
+            limit (int): The maximum number of lots to retrieve.
+
+        Returns:
+            list[dict]: Lots with their id, filename, lot_type and price, cheapest first.
+        """
+        async with self.session() as session:
+            lots = (await session.execute(
+                select(Account.id, Account.filename, Account.price)
+                .filter(
+                    Account.lot_type == lot_type,
+                    or_(Account.claimed_until.is_(None), Account.claimed_until < func.now())
+                )
+                .order_by(Account.price, Account.id)
+                .limit(limit)
+            )).all()
+
+        return [
+            {'id': lot.id, 'filename': lot.filename, 'lot_type': lot_type, 'price': lot.price}
+            for lot in lots
+        ]
+
+    async def claim_lots(self, telegram_id: int, ids: list[int], ttl: int) -> int:
+        """
+        Claims the given lots for a buyer once they are reserved in Redis,
+        so settlement only sells lots held by the buyer.
+        Lots claimed by another buyer in the meantime are not taken over.
+        Previous claims of the buyer are released first.
+
+        Args:
+            telegram_id (int): Telegram ID of the buyer.
+            ids (list[int]): IDs of the reserved lots.
+            ttl (int): Seconds the claim is held.
+
+        Returns:
+            int: Number of claimed lots.
+        """
+        async with self.session() as session:
+            await session.execute(
+                update(Account)
+                .filter(Account.claimed_by == telegram_id)
+                .values(claimed_by=None, claimed_until=None),
+                execution_options={'synchronize_session': False}
+            )
+            claimed = (await session.scalars(
+                update(Account)
+                .filter(
+                    Account.id.in_(ids),
+                    or_(Account.claimed_until.is_(None), Account.claimed_until < func.now())
+                )
+                .values(
+                    claimed_by=telegram_id,
+                    claimed_until=func.now() + timedelta(seconds=ttl)
+                )
+                .returning(Account.id),
+                execution_options={'synchronize_session': False}
+            )).all()
+            await session.commit()
+
+        log.info(f"ID: {telegram_id}| Claimed {len(claimed)} of {len(ids)} lots")
+        return len(claimed)
+
+    async def release_claims(self, telegram_id: int) -> None:
+        """
+        Releases all lots claimed by a buyer.
+
+        Args:
+            telegram_id (int): Telegram ID of the buyer.
+        """
+        async with self.session() as session:
+            await session.execute(
+                update(Account)
+                .filter(Account.claimed_by == telegram_id)
+                .values(claimed_by=None, claimed_until=None),
+                execution_options={'synchronize_session': False}
+            )
+            await session.commit()
+        log.info(f"ID: {telegram_id}| Released claimed lots")
+
+    async def delete_by_filename(self, filename: str) -> None:
         """
         Deletes an account from the database by filename.
         Args:
             filename (str): The filename of the account to delete.
         """
-        with self.session:
-            self.session.query(Account).filter(
-                Account.filename == filename
-            ).delete(synchronize_session=False)
-            self.session.commit()
+        async with self.session() as session:
+            lot_type = await session.scalar(
+                delete(Account)
+                .filter(Account.filename == filename)
+                .returning(Account.lot_type),
+                execution_options={'synchronize_session': False}
+            )
+            await session.commit()
+
+        if lot_type is not None:
+            invalidate_catalog(lot_type)
 
 
-    def create_account(
+    async def create_account(
         self,
         lot_type: str,
         lot_format: str,
@@ -707,16 +1096,102 @@ class AccountDb(Telegram):
             price=price,
             added_by=added_by
         )
-        try:
-            with self.session:
-                self.session.add(new_account)
-                self.session.commit()
-            log.info(f"Account created: {filename}. Added by: {added_by}")
-        except IntegrityError:
-            self.session.rollback()
-            log.error(f"Account already exists: {new_account}. Added by: {added_by}")
+        async with self.session() as session:
+            try:
+                session.add(new_account)
+                await session.commit()
+                log.info(f"Account created: {filename}. Added by: {added_by}")
+                invalidate_catalog(lot_type)
+            except IntegrityError:
+                await session.rollback()
+                log.error(f"Account already exists: {new_account}. Added by: {added_by}")
+
+    async def bulk_create_accounts(
+        self,
+        lot_type: str,
+        lot_format: str,
+        price: float,
+        added_by: str,
+        files: list[tuple[str, str]],
+        chunk_size: int = 1000
+    ) -> list[tuple[str, str]]:
+        """
+        Creates accounts in bulk. Files that were already sold (by filename or content hash)
+        are skipped with one query per chunk, the rest are inserted with
+        INSERT ... ON CONFLICT DO NOTHING, so lots that are already in stock are skipped as well.
+
+        Args:
+            lot_type (str): The type of the lots.
+            lot_format (str): The format of the lots.
+            price (float): The price of the lots.
+            added_by (str): The username of the admin who added the lots.
+            files (list[tuple[str, str]]): Filenames and texts of the lots.
+            chunk_size (int, optional): Number of lots per statement. Defaults to 1000.
+
+        Returns:
+            list[tuple[str, str]]: Filename and status for every file, in the input order.
+            The status is 'added', 'sold' (already in the sell log) or 'duplicate'.
+        """
+        results = []
+        seen = set()
+
+        async with self.session() as session:
+            for start in range(0, len(files), chunk_size):
+                chunk = files[start:start + chunk_size]
+                hashes = [hash_content(txt) for _, txt in chunk]
+                sold_logs = (await session.execute(
+                    select(SellLog.filename, SellLog.content_hash)
+                    .filter(or_(
+                        SellLog.filename.in_([filename for filename, _ in chunk]),
+                        SellLog.content_hash.in_(hashes)
+                    ))
+                )).all()
+                sold_filenames = {sold_log.filename for sold_log in sold_logs}
+                sold_hashes = {sold_log.content_hash for sold_log in sold_logs}
+                sold = {
+                    filename for (filename, _), txt_hash in zip(chunk, hashes)
+                    if filename in sold_filenames or txt_hash in sold_hashes
+                }
+
+                rows = []
+                for (filename, txt), txt_hash in zip(chunk, hashes):
+                    if filename in sold or filename in seen or txt_hash in seen:
+                        continue
+                    seen.update((filename, txt_hash))
+                    rows.append({
+                        'lot_type': lot_type,
+                        'lot_format': lot_format,
+                        'filename': filename,
+                        'txt': txt,
+                        # Already hashed for the sell log check, so the column default is skipped
+                        'content_hash': txt_hash,
+                        'price': price,
+                        'added_by': added_by
+                    })
+
+                added = set()
+                if rows:
+                    added = set(await session.scalars(
+                        insert(Account).on_conflict_do_nothing().returning(Account.filename),
+                        rows
+                    ))
+                    await session.commit()
+
+                for filename, _ in chunk:
+                    if filename in sold:
+                        results.append((filename, 'sold'))
+                    elif filename in added:
+                        results.append((filename, 'added'))
+                        added.discard(filename)
+                    else:
+                        results.append((filename, 'duplicate'))
+
+        invalidate_catalog(lot_type)
+        added_count = sum(1 for _, status in results if status == 'added')
+        log.info(f"Accounts created: {added_count} of {len(files)}. Added by: {added_by}")
+        return results
 
-    def update_price_by_lot_type(self, lot_type: str, new_price: float) -> None:
+    async def update_price_by_lot_type(self, lot_type: str, new_price: float) -> None:
         """
         Updates the price of all accounts with a given lot type.
 
@@ -727,9 +1202,13 @@ class AccountDb(Telegram):
         Returns:
             None
         """
-        with self.session:
-            self.session.query(Account) \
-                .filter(Account.lot_type == lot_type) \
-                .update({Account.price: new_price}, synchronize_session=False)
-            self.session.commit()
+        async with self.session() as session:
+            await session.execute(
+                update(Account)
+                .filter(Account.lot_type == lot_type)
+                .values(price=new_price)
+            )
+            await session.commit()
+
+        invalidate_catalog(lot_type)
         log.info(f"Price updated for {lot_type} to {new_price}")
@@ -0,0 +1,354 @@
+"""
+This module contains versioned schema migrations for existing databases.
+Fresh databases get the full schema from Base.metadata.create_all,
+so every statement here must be safe to run against it as well.
+"""
+
+import re
+from sqlalchemy import text, MetaData
+from sqlalchemy.engine import Engine, Connection
+from sqlalchemy.exc import ProgrammingError
+from utils.logs import log
+
+
+# Key for pg_advisory_lock, so concurrent deploys do not migrate twice
+MIGRATION_LOCK_ID = 7_310_001
+# Key for pg_try_advisory_xact_lock, so bot instances do not compact the inventory at the same time
+INVENTORY_COMPACT_LOCK_ID = 7_310_002
+
+# Statement-level triggers aggregate the changed rows, so bulk inserts, settlements
+# and price changes touch each (lot_type, price) row of the summary once.
+# Updates that do not change lot_type or price (e.g. claims) leave the summary alone.
+INVENTORY_SUMMARY_FUNCTIONS = """
+CREATE OR REPLACE FUNCTION inventory_summary_apply(delta_rows JSONB) RETURNS VOID AS $$
+BEGIN
+    INSERT INTO inventory_summary AS summary (lot_type, price, quantity)
+    SELECT delta.lot_type, delta.price, sum(delta.quantity)
+    FROM jsonb_to_recordset(delta_rows) AS delta(lot_type VARCHAR, price FLOAT, quantity INTEGER)
+    WHERE delta.lot_type IS NOT NULL AND delta.price IS NOT NULL
+    GROUP BY delta.lot_type, delta.price
+    ON CONFLICT (lot_type, price) DO UPDATE SET quantity = summary.quantity + EXCLUDED.quantity;
+
+    DELETE FROM inventory_summary WHERE quantity <= 0;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION inventory_summary_insert() RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM inventory_summary_apply(
+        (SELECT jsonb_agg(jsonb_build_object('lot_type', lot_type, 'price', price, 'quantity', quantity))
+         FROM (SELECT lot_type, price, count(*) AS quantity FROM new_rows GROUP BY lot_type, price) AS grouped)
+    );
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION inventory_summary_delete() RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM inventory_summary_apply(
+        (SELECT jsonb_agg(jsonb_build_object('lot_type', lot_type, 'price', price, 'quantity', quantity))
+         FROM (SELECT lot_type, price, -count(*) AS quantity FROM old_rows GROUP BY lot_type, price) AS grouped)
+    );
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION inventory_summary_update() RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM inventory_summary_apply(
+        (SELECT jsonb_agg(delta.row)
+         FROM old_rows
+         JOIN new_rows ON new_rows.id = old_rows.id
+         CROSS JOIN LATERAL (VALUES
+             (jsonb_build_object('lot_type', old_rows.lot_type, 'price', old_rows.price, 'quantity', -1)),
+             (jsonb_build_object('lot_type', new_rows.lot_type, 'price', new_rows.price, 'quantity', 1))
+         ) AS delta(row)
+         WHERE old_rows.lot_type IS DISTINCT FROM new_rows.lot_type
+            OR old_rows.price IS DISTINCT FROM new_rows.price)
+    );
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+# Replaces inventory_summary_apply of migration 3. The triggers append their deltas
+# to inventory_delta instead of upserting the summary row, so concurrent purchases
+# of the same lot type do not wait for each other's row lock until commit.
+# inventory_summary_compact folds the deltas into the summary, locking its rows
+# in (lot_type, price) order, and deletes only the rows it brought to zero.
+INVENTORY_DELTA_FUNCTIONS = f"""
+CREATE OR REPLACE FUNCTION inventory_summary_apply(delta_rows JSONB) RETURNS VOID AS $$
+BEGIN
+    INSERT INTO inventory_delta (lot_type, price, quantity)
+    SELECT delta.lot_type, delta.price, sum(delta.quantity)
+    FROM jsonb_to_recordset(delta_rows) AS delta(lot_type VARCHAR, price FLOAT, quantity INTEGER)
+    WHERE delta.lot_type IS NOT NULL AND delta.price IS NOT NULL
+    GROUP BY delta.lot_type, delta.price
+    HAVING sum(delta.quantity) <> 0;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION inventory_summary_compact() RETURNS INTEGER AS $$
+DECLARE
+    compacted INTEGER;
+    emptied JSONB;
+BEGIN
+    IF NOT pg_try_advisory_xact_lock({INVENTORY_COMPACT_LOCK_ID}) THEN
+        RETURN 0;
+    END IF;
+
+    WITH moved AS (
+        DELETE FROM inventory_delta RETURNING lot_type, price, quantity
+    ), applied AS (
+        INSERT INTO inventory_summary AS summary (lot_type, price, quantity)
+        SELECT lot_type, price, sum(quantity) FROM moved
+        GROUP BY lot_type, price
+        ORDER BY lot_type, price
+        ON CONFLICT (lot_type, price) DO UPDATE SET quantity = summary.quantity + EXCLUDED.quantity
+        RETURNING summary.lot_type, summary.price, summary.quantity
+    )
+    SELECT count(*), jsonb_agg(jsonb_build_object('lot_type', lot_type, 'price', price))
+        FILTER (WHERE quantity <= 0)
+    INTO compacted, emptied
+    FROM applied;
+
+    IF emptied IS NOT NULL THEN
+        DELETE FROM inventory_summary AS summary
+        USING jsonb_to_recordset(emptied) AS empty(lot_type VARCHAR, price FLOAT)
+        WHERE summary.lot_type = empty.lot_type
+          AND summary.price = empty.price
+          AND summary.quantity <= 0;
+    END IF;
+    RETURN compacted;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+# (version, description, statements, transactional)
+# Non-transactional steps run in autocommit mode, e.g. for CREATE INDEX CONCURRENTLY,
+# which does not block writes on large tables.
+MIGRATIONS: list[tuple[int, str, list[str], bool]] = [
+    (
+        1,
+        'Claim columns on accounts',
+        [
+            "ALTER TABLE accounts ADD COLUMN IF NOT EXISTS claimed_by BIGINT",
+            "ALTER TABLE accounts ADD COLUMN IF NOT EXISTS claimed_until TIMESTAMP WITH TIME ZONE",
+        ],
+        True
+    ),
+    (
+        2,
+        'Indexes for catalog, sell log and user lookups',
+        [
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_accounts_lot_type_price "
+            "ON accounts (lot_type, price)",
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_sell_log_filename ON sell_log (filename)",
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_sell_log_telegram_id ON sell_log (telegram_id)",
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_username ON users (username)",
+            "ANALYZE accounts",
+            "ANALYZE sell_log",
+            "ANALYZE users",
+        ],
+        False
+    ),
+    (
+        3,
+        'Inventory summary maintained by triggers on accounts',
+        [
+            "CREATE TABLE IF NOT EXISTS inventory_summary ("
+            "lot_type VARCHAR NOT NULL, "
+            "price FLOAT NOT NULL, "
+            "quantity INTEGER NOT NULL DEFAULT 0, "
+            "PRIMARY KEY (lot_type, price))",
+            INVENTORY_SUMMARY_FUNCTIONS,
+            "DROP TRIGGER IF EXISTS accounts_inventory_insert ON accounts",
+            "DROP TRIGGER IF EXISTS accounts_inventory_delete ON accounts",
+            "DROP TRIGGER IF EXISTS accounts_inventory_update ON accounts",
+            "CREATE TRIGGER accounts_inventory_insert AFTER INSERT ON accounts "
+            "REFERENCING NEW TABLE AS new_rows "
+            "FOR EACH STATEMENT EXECUTE FUNCTION inventory_summary_insert()",
+            "CREATE TRIGGER accounts_inventory_delete AFTER DELETE ON accounts "
+            "REFERENCING OLD TABLE AS old_rows "
+            "FOR EACH STATEMENT EXECUTE FUNCTION inventory_summary_delete()",
+            "CREATE TRIGGER accounts_inventory_update AFTER UPDATE ON accounts "
+            "REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows "
+            "FOR EACH STATEMENT EXECUTE FUNCTION inventory_summary_update()",
+            # Triggers hold a lock on accounts until commit, so the backfill is consistent
+            "DELETE FROM inventory_summary",
+            "INSERT INTO inventory_summary (lot_type, price, quantity) "
+            "SELECT lot_type, price, count(*) FROM accounts "
+            "WHERE lot_type IS NOT NULL AND price IS NOT NULL "
+            "GROUP BY lot_type, price",
+        ],
+        True
+    ),
+    (
+        4,
+        'Purchase counter on users',
+        [
+            "ALTER TABLE users ADD COLUMN IF NOT EXISTS purchase_count INTEGER NOT NULL DEFAULT 0",
+            "UPDATE users SET purchase_count = counts.quantity "
+            "FROM (SELECT telegram_id, count(*) AS quantity FROM sell_log GROUP BY telegram_id) AS counts "
+            "WHERE users.telegram_id = counts.telegram_id",
+        ],
+        True
+    ),
+    (
+        5,
+        'Unique content hashes instead of unique Text payloads',
+        [
+            "ALTER TABLE sell_log ADD COLUMN IF NOT EXISTS content_hash VARCHAR(64)",
+            "ALTER TABLE accounts ADD COLUMN IF NOT EXISTS content_hash VARCHAR(64)",
+            "UPDATE sell_log SET content_hash = encode(sha256(convert_to(content, 'UTF8')), 'hex') "
+            "WHERE content_hash IS NULL AND content IS NOT NULL",
+            "UPDATE accounts SET content_hash = encode(sha256(convert_to(txt, 'UTF8')), 'hex') "
+            "WHERE content_hash IS NULL AND txt IS NOT NULL",
+            "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS sell_log_content_hash_key "
+            "ON sell_log (content_hash)",
+            "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS accounts_content_hash_key "
+            "ON accounts (content_hash)",
+            "ALTER TABLE sell_log DROP CONSTRAINT IF EXISTS sell_log_content_key",
+            "ALTER TABLE accounts DROP CONSTRAINT IF EXISTS accounts_txt_key",
+        ],
+        False
+    ),
+    (
+        6,
+        'Inventory deltas appended by the triggers and compacted into the summary',
+        [
+            "CREATE TABLE IF NOT EXISTS inventory_delta ("
+            "id BIGSERIAL PRIMARY KEY, "
+            "lot_type VARCHAR NOT NULL, "
+            "price FLOAT NOT NULL, "
+            "quantity INTEGER NOT NULL)",
+            INVENTORY_DELTA_FUNCTIONS,
+        ],
+        True
+    ),
+]
+
+
+# Version of the schema this code expects
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+# Name of the index built by a concurrent index statement of a migration
+CONCURRENT_INDEX = re.compile(r"CREATE (?:UNIQUE )?INDEX CONCURRENTLY IF NOT EXISTS (\w+)")
+
+
+def get_schema_version(engine: Engine) -> int:
+    """
+    Retrieves the version of the database schema with a single query.
+
+    Returns:
+        int: The last applied migration, 0 if none were applied.
+    """
+    with engine.connect() as connection:
+        try:
+            return connection.execute(text("SELECT max(version) FROM schema_version")).scalar() or 0
+        except ProgrammingError:
+            # No schema_version table yet
+            return 0
+
+
+def is_applied(connection: Connection, version: int) -> bool:
+    """
+    Checks if a migration was already applied, e.g. by a concurrent deploy.
+    """
+    return bool(connection.execute(
+        text("SELECT 1 FROM schema_version WHERE version = :version"), {'version': version}
+    ).scalar())
+
+
+def is_valid_index(connection: Connection, name: str) -> bool | None:
+    """
+    Checks if an index can be used, i.e. its concurrent build did not fail.
+
+    Returns:
+        bool | None: Validity of the index, None if there is no such index.
+    """
+    return connection.execute(
+        text("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)"), {'name': name}
+    ).scalar()
+
+
+def apply_migration(engine: Engine, version: int, statements: list[str], transactional: bool) -> bool:
+    """
+    Applies a single migration and records its version.
+
+    Returns:
+        bool: True if the migration was applied, False if it was already there.
+    """
+    if transactional:
+        with engine.begin() as connection:
+            if is_applied(connection, version):
+                return False
+            for statement in statements:
+                connection.execute(text(statement))
+            connection.execute(
+                text("INSERT INTO schema_version (version) VALUES (:version)"), {'version': version}
+            )
+        return True
+
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        if is_applied(connection, version):
+            return False
+        for statement in statements:
+            index = CONCURRENT_INDEX.match(statement)
+            # A failed concurrent build leaves an invalid index behind, which IF NOT EXISTS would keep
+            if index and is_valid_index(connection, index[1]) is False:
+                connection.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {index[1]}"))
+            connection.execute(text(statement))
+            # Later steps, e.g. dropping the constraints it replaces, rely on the index
+            if index and not is_valid_index(connection, index[1]):
+                raise RuntimeError(f"Index {index[1]} of migration {version} is not valid")
+        connection.execute(
+            text("INSERT INTO schema_version (version) VALUES (:version)"), {'version': version}
+        )
+    return True
+
+
+def migrate(engine: Engine, version: int | None = None) -> None:
+    """
+    Applies pending migrations in order while holding an advisory lock.
+
+    Args:
+        engine (Engine): Engine of the database to migrate.
+        version (int | None, optional): The current schema version, if already known.
+    """
+    if version is None:
+        version = get_schema_version(engine)
+    pending = [migration for migration in MIGRATIONS if migration[0] > version]
+    if not pending:
+        return
+
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as lock_connection:
+        lock_connection.execute(text("SELECT pg_advisory_lock(:lock)"), {'lock': MIGRATION_LOCK_ID})
+        try:
+            lock_connection.execute(text(
+                "CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY)"
+            ))
+            for number, description, statements, transactional in pending:
+                if apply_migration(engine, number, statements, transactional):
+                    log.info(f"Applied migration {number}: {description}")
+        finally:
+            lock_connection.execute(
+                text("SELECT pg_advisory_unlock(:lock)"), {'lock': MIGRATION_LOCK_ID})
+
+
+def ensure_schema(engine: Engine, metadata: MetaData) -> None:
+    """
+    Brings the database schema up to date. When the schema is current,
+    which is the case on every restart, this is a single query.
+
+    Args:
+        engine (Engine): Engine of the database.
+        metadata (MetaData): Metadata of the models, created on databases without a schema version.
+    """
+    version = get_schema_version(engine)
+    if version >= LATEST_VERSION:
+        return
+
+    if version == 0:
+        metadata.create_all(engine)
+    migrate(engine, version)
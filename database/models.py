@@ -2,13 +2,21 @@
 This module contains classes for working with the database.
 """
 
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+import hashlib
+import time
 from datetime import datetime
+from typing import AsyncIterator, Hashable
 from pytz import timezone
 from datetime import datetime
 from decimal import Decimal
 from sqlalchemy import Column, Integer, String, Float, DateTime, Boolean, BigInteger, Text, ForeignKey, Numeric
+from sqlalchemy import Index
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, declarative_base, relationship, validates
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.orm import sessionmaker, declarative_base, relationship, validates, deferred
 from env import Config as config
 
 
@@ -17,9 +25,149 @@ tz = timezone(config.timezone)
 engine = create_engine(config.database_url)
 Session = sessionmaker(bind=engine)
 session = Session()
+
+# Async engine used by the bot handlers. Shares DATABASE_URL with the sync engine,
+# but goes through asyncpg so queries do not block the event loop.
+# Every connection keeps up to DB_STATEMENT_CACHE_SIZE server-side prepared statements,
+# 0 disables them (e.g. behind pgbouncer in transaction mode).
+async_engine = create_async_engine(
+    make_url(config.database_url).set(drivername='postgresql+asyncpg'),
+    pool_size=int(config.db_pool_size),
+    max_overflow=int(config.db_max_overflow),
+    pool_timeout=int(config.db_pool_timeout),
+    pool_pre_ping=True,
+    connect_args={'prepared_statement_cache_size': int(config.db_statement_cache_size)}
+)
+AsyncSessionLocal = async_sessionmaker(bind=async_engine, expire_on_commit=False)
+
+# Session of the Telegram update being processed, set by DbSessionMiddleware
+current_session: ContextVar[AsyncSession | None] = ContextVar('current_session', default=None)
+
+
+@asynccontextmanager
+async def session_scope() -> AsyncIterator[AsyncSession]:
+    """
+    Yields the session of the current Telegram update.
+    Outside of an update (startup, background tasks) opens a short-lived session instead.
+
+    When the outermost scope of an update exits, its transaction is ended and the
+    connection goes back to the pool, so it is not held idle in transaction while
+    the handler awaits the Telegram API. Writes commit themselves before that,
+    so what is left is the transaction of reads.
+    """
+    request_session = current_session.get()
+    if request_session is not None:
+        depth = request_session.info.get('depth', 0)
+        request_session.info['depth'] = depth + 1
+        try:
+            yield request_session
+        except BaseException:
+            if depth == 0:
+                await request_session.rollback()
+            raise
+        finally:
+            request_session.info['depth'] = depth
+        # Nested scopes are part of the unit of work of the outermost one
+        if depth == 0 and request_session.in_transaction():
+            await request_session.commit()
+        return
+
+    async with AsyncSessionLocal() as new_session:
+        yield new_session
+
+
+# Optional read replica for menu and profile reads. Without DATABASE_REPLICA_URL
+# every read goes to the primary.
+replica_engine = create_async_engine(
+    make_url(config.database_replica_url).set(drivername='postgresql+asyncpg'),
+    pool_size=int(config.db_pool_size),
+    max_overflow=int(config.db_max_overflow),
+    pool_timeout=int(config.db_pool_timeout),
+    pool_pre_ping=True,
+    connect_args={'prepared_statement_cache_size': int(config.db_statement_cache_size)}
+) if config.database_replica_url else None
+ReplicaSessionLocal = async_sessionmaker(
+    bind=replica_engine, expire_on_commit=False) if replica_engine else None
+
+# Keys written recently, mapped to the time.monotonic() until which their reads stay on the primary
+recent_writes: dict[Hashable, float] = {}
+
+
+def mark_written(*keys: Hashable) -> None:
+    """
+    Pins reads of the current update, and reads of the given keys from any update,
+    to the primary for the replica lag window, so they see the write.
+    """
+    request_session = current_session.get()
+    if request_session is not None:
+        request_session.info['wrote'] = True
+
+    now = time.monotonic()
+    if len(recent_writes) > 10_000:
+        for key in [key for key, deadline in recent_writes.items() if deadline <= now]:
+            del recent_writes[key]
+    for key in keys:
+        recent_writes[key] = now + float(config.replica_sticky_seconds)
+
+
+def reads_primary(*keys: Hashable) -> bool:
+    """
+    Checks if a read of the given keys must go to the primary.
+    """
+    if ReplicaSessionLocal is None:
+        return True
+    request_session = current_session.get()
+    if request_session is not None and request_session.info.get('wrote'):
+        return True
+    now = time.monotonic()
+    return any(recent_writes.get(key, 0) > now for key in keys)
+
+
+@asynccontextmanager
+async def read_scope(*keys: Hashable) -> AsyncIterator[AsyncSession]:
+    """
+    Yields a session for read-only queries of the given keys.
+    Goes to the replica unless the current update or a recent write of the keys
+    requires the primary, see mark_written.
+    """
+    if reads_primary(*keys):
+        async with session_scope() as session:
+            yield session
+        return
+
+    async with ReplicaSessionLocal() as replica_session:
+        yield replica_session
+
+
 Base = declarative_base()
 
 
+def local_now() -> datetime:
+    """
+    Returns the current time in the configured timezone without tzinfo,
+    as stored in the TIMESTAMP WITHOUT TIME ZONE columns.
+    """
+    return datetime.now(tz).replace(tzinfo=None)
+
+
+def hash_content(content: str | None) -> str | None:
+    """
+    Returns the hex SHA-256 of a lot payload. Uniqueness of payloads is enforced
+    on this fixed-size hash instead of the Text columns themselves.
+    """
+    if content is None:
+        return None
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def content_hash_default(column: str):
+    """
+    Column default that hashes another column of the inserted row.
+    Works for single and bulk inserts alike.
+    """
+    return lambda context: hash_content(context.get_current_parameters().get(column))
+
+
 class User(Base):
     __tablename__ = 'users'
 
@@ -31,7 +179,13 @@ class User(Base):
     language = Column(String)
     last_visit = Column(DateTime)
     is_ban = Column(Boolean, default=False)
-    registration_date = Column(DateTime, default=lambda: datetime.now(tz))
+    registration_date = Column(DateTime, default=local_now)
+    # Number of purchased lots, maintained by purchase settlement
+    purchase_count = Column(Integer, nullable=False, default=0, server_default='0')
+
+    __table_args__ = (
+        Index('ix_users_username', 'username'),
+    )
 
     # Relationships
     sell_logs = relationship("SellLog", back_populates="user")
@@ -47,15 +201,21 @@ class SellLog(Base):
     __tablename__ = 'sell_log'
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    time = Column(DateTime, default=lambda: datetime.now(tz))
+    time = Column(DateTime, default=local_now)
     telegram_id = Column(BigInteger, ForeignKey('users.telegram_id'))
     name = Column(String)
     username = Column(String)
     type = Column(String)
     filename = Column(String)
-    content = Column(Text, unique=True)
+    content = Column(Text)
+    content_hash = Column(String(64), unique=True, default=content_hash_default('content'))
     price = Column(String)
 
+    __table_args__ = (
+        Index('ix_sell_log_filename', 'filename'),
+        Index('ix_sell_log_telegram_id', 'telegram_id'),
+    )
+
     # Relationships
     user = relationship("User", back_populates="sell_logs")
 
@@ -67,9 +227,46 @@ class Account(Base):
     lot_type = Column(String)
     lot_format = Column(String)
     filename = Column(String, unique=True)
-    txt = Column(Text, unique=True)
+    # Payloads are only needed at delivery, so they are not loaded with the row
+    txt = deferred(Column(Text))
+    content_hash = Column(String(64), unique=True, default=content_hash_default('txt'))
     price = Column(Float)
     added_by = Column(String)
+    # Telegram ID of the buyer holding the lot and the moment the hold lapses
+    claimed_by = Column(BigInteger)
+    claimed_until = Column(DateTime(timezone=True))
+
+    __table_args__ = (
+        # Serves the catalog GROUP BY lot_type, price with index-only scans
+        # and the cheapest-first lookups by lot_type
+        Index('ix_accounts_lot_type_price', 'lot_type', 'price'),
+    )
+
+
+class InventorySummary(Base):
+    """
+    Number of lots in stock per lot type and price, up to the last compaction.
+    The stock is this quantity plus the deltas of InventoryDelta.
+    """
+    __tablename__ = 'inventory_summary'
+
+    lot_type = Column(String, primary_key=True)
+    price = Column(Float, primary_key=True)
+    quantity = Column(Integer, nullable=False, default=0)
+
+
+class InventoryDelta(Base):
+    """
+    Change of the stock per lot type and price, appended by the triggers on the
+    accounts table and folded into InventorySummary by inventory_summary_compact,
+    see migrations 3 and 6.
+    """
+    __tablename__ = 'inventory_delta'
+
+    id = Column(BigInteger, primary_key=True)
+    lot_type = Column(String, nullable=False)
+    price = Column(Float, nullable=False)
+    quantity = Column(Integer, nullable=False)
 
 
 # Base.metadata.create_all(engine)
@@ -15,6 +15,12 @@ class Config:
     channel_name = os.getenv('CHANNEL_NAME')
     channel_url = os.getenv('CHANNEL_URL')
     database_url = os.environ.get('DATABASE_URL')
+    database_replica_url = os.environ.get('DATABASE_REPLICA_URL')
+    replica_sticky_seconds = os.environ.get('REPLICA_STICKY_SECONDS', '5')
+    db_pool_size = os.environ.get('DB_POOL_SIZE', '10')
+    db_max_overflow = os.environ.get('DB_MAX_OVERFLOW', '20')
+    db_pool_timeout = os.environ.get('DB_POOL_TIMEOUT', '30')
+    db_statement_cache_size = os.environ.get('DB_STATEMENT_CACHE_SIZE', '500')
     timezone = os.environ.get('TIMEZONE')
     channel_id = os.environ.get('CHANNEL_ID')
     admins = os.environ.get('ADMINS')
@@ -22,6 +28,19 @@ class Config:
     redis_host = os.environ.get('REDIS_HOST')
     redis_port = os.environ.get('REDIS_PORT')
     redis_expire = os.environ.get('REDIS_EXPIRE')
+    redis_prefix = os.environ.get('REDIS_PREFIX', 'shop')
+    # 1 to connect to a Redis Cluster
+    redis_cluster = os.environ.get('REDIS_CLUSTER')
+    # Shards of the reserved stock counters, a user goes to shard telegram_id % shards.
+    # Change it only without open reservations, their counters would stay in the old shards
+    redis_stock_shards = os.environ.get('REDIS_STOCK_SHARDS', '16')
+    reservation_sweep_interval = os.environ.get('RESERVATION_SWEEP_INTERVAL', '10')
+    fsm_storage = os.environ.get('FSM_STORAGE', 'memory')
+    fsm_state_ttl = os.environ.get('FSM_STATE_TTL', '86400')
+    fsm_input_ttl = os.environ.get('FSM_INPUT_TTL', '900')
+    catalog_cache_ttl = os.environ.get('CATALOG_CACHE_TTL', '30')
+    activity_flush_interval = os.environ.get('ACTIVITY_FLUSH_INTERVAL', '5')
+    inventory_compact_interval = os.environ.get('INVENTORY_COMPACT_INTERVAL', '5')
     testnet = os.environ.get('TESTNET')
     pay_currency = os.environ.get('PAY_CURRENCY')
     invoice_counter = os.environ.get('INVOICE_COUNTER')
@@ -22,16 +22,22 @@ from keyboard.keyboard_sender import KeyboardSender
 from variables.RUS import Strings as var
 from env import Config as config
 from utils.logs import log
-from database.db import UserDb, AccountDb, Telegram, SelllogDb
-from database.models import Base, engine
-from populate_database import init_db
+from database.db import UserDb, AccountDb, Telegram, SelllogDb, activity_buffer, inventory_compactor
+from database.models import Base, engine, async_engine, replica_engine
+from database.migrations import ensure_schema
 from utils.decorators import exception_handler
-from utils.cache import RedisManager
+from utils.cache import RedisManager, ReservationSweeper
+from utils.storage import StateRedisStorage
 from utils.states import StateManager, StateList
 from utils.mix import substract_lots
+from utils.middlewares import DbSessionMiddleware, ActivityMiddleware
 from utils.payment import check_payment, create_invoice
 
 
+# Candidates fetched on top of the requested quantity when reserving lots
+RESERVE_CANDIDATES_EXTRA = 20
+
+
 class Main:
     """
     Initializes the main bot components and sets up the necessary instances
@@ -42,20 +48,45 @@ class Main:
 
     def __init__(self) -> None:
         self.bot = Bot(token=config.token)
-        self.storage = MemoryStorage()
+        self.redis = RedisManager()
+        self.storage = self.create_storage()
         self.dp = Dispatcher(self.bot, storage=self.storage)
+        self.dp.middleware.setup(DbSessionMiddleware())
 
         self.keyboard = Keyboards()
         self.send_keyboard = KeyboardSender(bot=self.bot)
         self.user = UserDb()
+        self.dp.middleware.setup(ActivityMiddleware(user=self.user))
         self.account = AccountDb()
         self.selllog = SelllogDb()
         self.telegram_subs = TelegramChannelSubscription(bot=self.bot)
-        self.redis = RedisManager()
         self.telegram = Telegram()
+        self.sweeper = ReservationSweeper(
+            manager=self.redis,
+            interval=float(config.reservation_sweep_interval)
+        )
 
         self.register_handlers()
 
+    def create_storage(self) -> MemoryStorage | StateRedisStorage:
+        """
+        Creates the FSM storage selected by FSM_STORAGE. The Redis storage is shared
+        by all bot instances, and abandoned dialogs expire with the TTL of their state.
+        """
+        if config.fsm_storage != 'redis':
+            return MemoryStorage()
+
+        return StateRedisStorage(
+            client=self.redis.client,
+            state_ttls={
+                # The lot menu lives as long as the reservation of the lots
+                StateList.LOT_MENU.state: int(config.redis_expire),
+                StateList.TOPUP_BALANCE.state: int(config.fsm_input_ttl),
+            },
+            default_ttl=int(config.fsm_state_ttl),
+            prefix=self.redis.prefix
+        )
+
     def register_handlers(self) -> None:
         """
         Register all handlers for the bot.
@@ -98,8 +129,8 @@ class Main:
     async def start(self, message: Message, state: FSMContext) -> None:
         """
         Handles the /start command for the Telegram bot. Finishes the current state,
-        retrieves user data from the database, and creates a new user if not found.
-        If the user is already in the database and subscribed to the channel, navigates
+        creates the user or refreshes their data with a single upsert.
+        If the user was already in the database and subscribed to the channel, navigates
         to the main menu. Otherwise, sends a welcome message with a subscription
         keyboard to prompt the user to subscribe to the channel.
 
@@ -109,10 +140,8 @@ class Main:
         """
         await state.finish()
 
-        user_data = self.user.get_user(obj=message)
-        if not user_data:
-            self.user.create_user(obj=message)
-        elif user_data and await self.telegram_subs.check_member(obj=message):
+        user_data = await self.user.upsert_user(obj=message)
+        if not user_data.get('is_new') and await self.telegram_subs.check_member(obj=message):
             await self.main_menu(message, state)
             return
 
@@ -143,11 +172,11 @@ class Main:
         text = f'***{var.available}***\n\n'
 
         telegram = self.telegram.data(obj=callback)
-        reserved_lots = await self.redis.get_all_reserved_types(telegram_id=telegram.telegram_id)
-        account_stats = self.account.get_description_main()
+        reserved_stock = await self.redis.get_reserved_stock()
+        account_stats = await self.account.get_description_main()
 
         substracted_stats = substract_lots(
-            db_stats=account_stats, reserved_lots=reserved_lots)
+            db_stats=account_stats, reserved_stock=reserved_stock)
 
         for lot_type, price, quantity in substracted_stats:
             text += f"*{lot_type}* /// $*{price}* /// *{quantity}**{var.pcs}*\n"
@@ -170,7 +199,7 @@ class Main:
         await state.finish()
 
         buttons = list()
-        lot_types = self.account.get_lot_type()
+        lot_types = await self.account.get_lot_type()
 
         for lot_type in lot_types:
             buttons.append(lot_type)
@@ -187,9 +216,12 @@ class Main:
         await state.finish()
 
         lot_type = callback.data.split('_')[-1]
-        data = self.account.get_lot_details(lot_type=lot_type)
+        data = await self.account.get_lot_details(lot_type=lot_type)
+        reserved_stock = await self.redis.get_reserved_stock()
+        # data is the cheapest price of the lot type, which reservations take first
+        available_quantity = max(data[2] - reserved_stock.get(lot_type, 0), 0)
 
-        desc = f'{lot_type}\n{var.price}{data[1]}\n{var.available}{data[2]}\n\n{var.lot_buy_desc}'
+        desc = f'{lot_type}\n{var.price}{data[1]}\n{var.available}{available_quantity}\n\n{var.lot_buy_desc}'
 
         keyboard = self.keyboard.one_button()
         await self.send_keyboard.keyboard(
@@ -201,7 +233,14 @@ class Main:
         manager = StateManager(state)
         await manager.set_state(StateList.LOT_MENU)
         await manager.set_data(key="lot_type", value=lot_type)
-        await manager.set_data(key="available_quantity", value=data[2])
+        await manager.set_data(key="available_quantity", value=available_quantity)
+
+    async def release_lots(self, telegram_id: int) -> None:
+        """
+        Releases the lots reserved in Redis and claimed in the database by a user.
+        """
+        await self.redis.clear_reserved(telegram_id=telegram_id)
+        await self.account.release_claims(telegram_id=telegram_id)
 
     @exception_handler
     async def handle_lot_input(self, message: Message, state: FSMContext):
@@ -220,8 +259,6 @@ class Main:
         manager = StateManager(state)
         lot_data = await manager.get_all_data()
         lot_type = lot_data.get("lot_type")
-        lots = self.account.get_lot_texts_by_type(lot_type=lot_type, quantity=lot_quantity)
-        await manager.set_data(key="lots", value=lots)
 
         available_quantity = int(lot_data.get("available_quantity"))
         if available_quantity < lot_quantity:
@@ -229,19 +266,41 @@ class Main:
             await self.main_menu(message, state)
             return
 
-        lot_info = self.account.get_lot_details(lot_type)
-        await manager.set_data(key="lot_quantity", value=lot_quantity)
-        total_price = float(lot_info[1]) * lot_quantity
-        await manager.set_data(key="lot_total_price", value=total_price)
+        telegram_id = self.telegram.data(obj=message).telegram_id
+        # Extra candidates cover lots reserved by concurrent buyers but not claimed yet
+        candidates = await self.account.get_free_lots(
+            lot_type=lot_type, limit=lot_quantity + RESERVE_CANDIDATES_EXTRA)
+        lots = await self.redis.reserve_lots(
+            telegram_id=telegram_id, lots=candidates, quantity=lot_quantity)
+        if not lots:
+            await message.answer(var.input_quantity_available)
+            await self.main_menu(message, state)
+            return
+
+        claimed = await self.account.claim_lots(
+            telegram_id=telegram_id,
+            ids=[lot.get("id") for lot in lots],
+            ttl=int(config.redis_expire)
+        )
+        if claimed < len(lots):
+            await self.release_lots(telegram_id=telegram_id)
+            await message.answer(var.input_quantity_available)
+            await self.main_menu(message, state)
+            return
 
-        balance = self.user.get_balance()
+        # The quote is priced from the reserved lots themselves
+        lot_info = await self.account.get_lot_details(lot_type)
+        total_price = round(sum(lot.get("price") for lot in lots), 2)
+
+        balance = await self.user.get_balance(obj=message)
         if balance < total_price:
+            await self.release_lots(telegram_id=telegram_id)
             await message.answer(var.input_balance_exception)
             await self.main_menu(message, state)
             return
 
-        telegram_id = self.telegram.data(obj=message).telegram_id
-        await self.redis.reserve_lots(telegram_id=telegram_id, lots=lots)
+        await manager.set_data(key="lot_quantity", value=lot_quantity)
+        await manager.set_data(key="lot_total_price", value=total_price)
 
         desc = (
             f"{var.lot_list}: {lot_data.get('lot_type')}\n"
@@ -278,28 +337,28 @@ class Main:
             await self.main_menu(callback, state)
             return
 
-        self.user.topup_balance(
-            obj=callback, topup_quantity=-abs(lot_data.get("lot_total_price")))
-
-        for lot in lot_data.get("lots"):
-            values = list(lot.values())
-            result = self.selllog.sell_log(
-                folder_name=lot_data.get("lot_type"),
-                filename=values[0],
-                content=values[1],
-                price=lot_data.get("lot_total_price"),
-                obj=callback
-            )
-            self.account.delete_by_filename(
-                filename=values[0])
-            if result:
-                await self.bot.send_message(chat_id=config.my_id, text=f"{var.duplicate_logs}{result}")
-                continue
+        delivered, duplicates = await self.selllog.settle_purchase(
+            obj=callback,
+            lot_type=lot_data.get("lot_type"),
+            ids=[lot.get("id") for lot in lots],
+            total_price=abs(lot_data.get("lot_total_price"))
+        )
+
+        if not delivered:
+            await callback.answer(var.purchase_exception)
+            await self.main_menu(callback, state)
+            return
+
+        # The lots are sold, so the holds no longer count against the stock
+        await self.redis.clear_reserved(telegram_id=telegram_id)
+
+        for filename in duplicates:
+            await self.bot.send_message(chat_id=config.my_id, text=f"{var.duplicate_logs}{filename}")
 
         zip_buffer = BytesIO()
 
         with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zipf:
-            for lot in lots:
+            for lot in delivered:
                 data = list(lot.values())
                 file_data = data[1].encode("utf-8")
                 zipf.writestr(data[0], file_data)
@@ -314,8 +373,6 @@ class Main:
             document=InputFile(zip_file, filename=zip_file.name)
         )
 
-        await self.redis.clear_reserved(telegram_id=telegram_id)
-
         keyboard = self.keyboard.one_button()
         await self.send_keyboard.keyboard(
             obj=callback,
@@ -327,7 +384,7 @@ class Main:
     async def profile(self, callback: CallbackQuery, state: FSMContext) -> None:
         await state.finish()
 
-        user_data = self.user.get_balance_and_registration(obj=callback)
+        user_data = await self.user.get_balance_and_registration(obj=callback)
 
         desc = (
             f'{var.ids}: {callback.message.chat.id}\n'
@@ -387,7 +444,7 @@ class Main:
             await self.main_menu(message, state)
             return
 
-        is_topup = self.user.topup_balance(
+        is_topup = await self.user.topup_balance(
             obj=message, topup_quantity=topup_quantity)
         if not is_topup:
             await message.answer(var.topup_exception)
@@ -492,23 +549,22 @@ class Main:
         manager = StateManager(state)
         data = await manager.get_all_data()
 
-        success_added = 0
-        for filename, content in extracted_files:
-            if self.selllog.exists_by_filename(obj=message, filename=filename):
-                await self.bot.send_message(
-                    chat_id=config.my_id, text=f"{var.duplicate_download}{filename}")
-                await message.answer(f'{var.duplicate_download}{filename}')
-                continue
-
-            self.account.create_account(
-                lot_type=data.get('lot_type'),
-                lot_format='txt',
-                filename=filename,
-                txt=content,
-                price=data.get('price'),
-                added_by=message.from_user.username
-            )
-            success_added += 1
+        results = await self.account.bulk_create_accounts(
+            lot_type=data.get('lot_type'),
+            lot_format='txt',
+            price=data.get('price'),
+            added_by=message.from_user.username,
+            files=extracted_files
+        )
+
+        skipped = [filename for filename, status in results if status != 'added']
+        success_added = len(results) - len(skipped)
+
+        # Report skipped files in batches to stay within the message length limit
+        for start in range(0, len(skipped), 50):
+            text = f"{var.duplicate_download}{', '.join(skipped[start:start + 50])}"
+            await self.bot.send_message(chat_id=config.my_id, text=text)
+            await message.answer(text)
 
         text = var.admin_add_lots_final_message.format(
             success_added=success_added,
@@ -561,7 +617,7 @@ class Main:
         username = data.get('username')
         balance = float(message.text.strip())
 
-        is_changed = self.user.change_user_balance(username=username, change_balance=balance)
+        is_changed = await self.user.change_user_balance(username=username, change_balance=balance)
         if is_changed:
             text = var.admin_change_balance_success.format(
                 username=username, change_balance=balance)
@@ -580,7 +636,8 @@ class Main:
     async def admin_change_price(self, callback: CallbackQuery, state: FSMContext) -> None:
         await state.finish()
 
-        keyboard = self.keyboard.admin_change_lot_price(lot_types=self.account.get_lot_type())
+        lot_types = await self.account.get_lot_type()
+        keyboard = self.keyboard.admin_change_lot_price(lot_types=lot_types)
         await self.send_keyboard.keyboard(
             obj=callback,
             text=var.admin_change_price_type,
@@ -620,7 +677,7 @@ class Main:
         data = await manager.get_all_data()
         lot_type = data.get('lot_type')
 
-        self.account.update_price_by_lot_type(
+        await self.account.update_price_by_lot_type(
             lot_type=lot_type, new_price=new_price)
 
         text = var.admin_change_price_success.format(
@@ -637,19 +694,35 @@ class Main:
     @exception_handler
     async def run(self):
         await self.redis.connect()
+        activity_buffer.start()
+        inventory_compactor.start()
+        await self.sweeper.start()
         log.info("***Bot started***")
 
         try:
             await self.dp.start_polling(self.bot)
         finally:
+            await self.sweeper.stop()
+            await activity_buffer.stop()
+            await inventory_compactor.stop()
             session = await self.bot.get_session()
             await session.close()
+            await async_engine.dispose()
+            if replica_engine is not None:
+                await replica_engine.dispose()
 
 
 if __name__ == "__main__":
-    # Create and populate the database
-    Base.metadata.create_all(engine)
-    init_db()
+    import argparse
+    parser = argparse.ArgumentParser(description='Telegram shop bot')
+    parser.add_argument(
+        '--seed', action='store_true', help='Fill an empty database with fake data (development only)')
+    args = parser.parse_args()
+
+    ensure_schema(engine, Base.metadata)
+    if args.seed:
+        from populate_database import init_db
+        init_db()
 
     bot_instance = Main()
     import asyncio
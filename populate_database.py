@@ -1,9 +1,26 @@
 from faker import Faker
+import argparse
+import csv
+import io
+import itertools
+import math
 import random
-from database.models import User, SellLog, Account, session
+import string
+import time
+from datetime import timedelta
+from sqlalchemy import text
+from database.models import User, SellLog, Account, Base, engine, session, hash_content, local_now
+from database.migrations import ensure_schema
 
 fake = Faker()
 
+# Sets the purchase counter of every user from their sell logs, like migration 4
+PURCHASE_COUNT_BACKFILL = (
+    "UPDATE users SET purchase_count = counts.quantity "
+    "FROM (SELECT telegram_id, count(*) AS quantity FROM sell_log GROUP BY telegram_id) AS counts "
+    "WHERE users.telegram_id = counts.telegram_id"
+)
+
 def populate_db():
     # Users
     users = []
@@ -49,6 +66,8 @@ def populate_db():
         session.add(account)
         accounts.append(account)
 
+    session.commit()
+    session.execute(text(PURCHASE_COUNT_BACKFILL))
     session.commit()
     print("✅ Database populated successfully.")
 
@@ -56,3 +75,192 @@ def init_db():
     if not session.query(User).first():
         populate_db()
 
+
+# Generator of large synthetic datasets for benchmarking, written through COPY.
+# Lot types follow a Zipf distribution, a few popular types hold most of the stock.
+
+LOT_FORMATS = ['txt', 'logpass', 'session']
+LANGUAGES = ['RUS', 'RUS', 'RUS', 'ENG']
+
+
+def zipf_weights(count: int, exponent: float = 1.1) -> list[float]:
+    """
+    Returns the cumulative Zipf weights of count ranks, for random.choices(cum_weights=...).
+    """
+    return list(itertools.accumulate(1 / rank ** exponent for rank in range(1, count + 1)))
+
+
+def make_lot_types(count: int, rng: random.Random) -> list[tuple[str, list[float]]]:
+    """
+    Generates lot types with their price tiers.
+
+    Returns:
+        list[tuple[str, list[float]]]: Lot types from the most to the least popular,
+        each with 1 to 4 prices.
+    """
+    lot_types = []
+    for number in range(count):
+        base = round(rng.lognormvariate(0.5, 0.8), 2) or 0.1
+        tiers = sorted({round(base * factor, 2) for factor in rng.sample([1, 1.5, 2, 3], rng.randint(1, 4))})
+        lot_types.append((f"type_{number:03d}", tiers))
+    return lot_types
+
+
+def make_payload(number: int, rng: random.Random, mean_size: int) -> str:
+    """
+    Generates a lot payload of a log-normal size around mean_size bytes.
+    The number makes every payload, and so its content hash, unique.
+    """
+    size = max(16, int(rng.lognormvariate(math.log(mean_size), 0.6)))
+    line = f"login{number}:" + ''.join(rng.choices(string.ascii_letters + string.digits, k=12))
+    filler = rng.randbytes(max(0, size - len(line) - 1) // 2).hex()
+    return f"{line}\n{filler}"
+
+
+def copy_rows(cursor, table: str, columns: list[str], rows, batch_size: int) -> int:
+    """
+    Streams rows into a table with COPY ... FROM STDIN, one COPY per batch.
+
+    Returns:
+        int: Number of copied rows.
+    """
+    statement = f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)"
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    copied = pending = 0
+
+    def flush():
+        buffer.seek(0)
+        cursor.copy_expert(statement, buffer)
+        buffer.seek(0)
+        buffer.truncate()
+
+    for row in rows:
+        writer.writerow(row)
+        pending += 1
+        if pending == batch_size:
+            flush()
+            copied += pending
+            pending = 0
+    if pending:
+        flush()
+        copied += pending
+    return copied
+
+
+def generate_dataset(
+        users: int,
+        accounts: int,
+        sell_logs: int,
+        lot_types: int = 40,
+        payload_size: int = 300,
+        batch_size: int = 50_000,
+        seed: int = 0
+    ) -> None:
+    """
+    Loads a synthetic dataset of the given size into the database with COPY.
+
+    Args:
+        users (int): Number of users.
+        accounts (int): Number of lots in stock.
+        sell_logs (int): Number of sold lots, bought by users with Zipf-distributed activity.
+        lot_types (int, optional): Number of lot types. Defaults to 40.
+        payload_size (int, optional): Mean payload size in bytes. Defaults to 300.
+        batch_size (int, optional): Rows per COPY statement. Defaults to 50 000.
+        seed (int, optional): Seed of the random generator. Defaults to 0.
+    """
+    rng = random.Random(seed)
+    types = make_lot_types(lot_types, rng)
+    type_weights = zipf_weights(len(types))
+    now = local_now()
+    telegram_ids = rng.sample(range(100_000_000, 8_000_000_000), users)
+    started = time.monotonic()
+
+    def user_rows():
+        for telegram_id in telegram_ids:
+            registration = now - timedelta(seconds=rng.randint(0, 365 * 24 * 3600))
+            last_visit = registration + (now - registration) * rng.random()
+            yield (
+                telegram_id, f"User {telegram_id}", f"user{telegram_id}",
+                f"{rng.choice([0, 0, rng.uniform(0, 200)]):.2f}", rng.choice(LANGUAGES),
+                last_visit, rng.random() < 0.01, registration
+            )
+
+    def lot_rows(count: int, offset: int):
+        for number in range(offset, offset + count):
+            lot_type, prices = rng.choices(types, cum_weights=type_weights)[0]
+            payload = make_payload(number, rng, payload_size)
+            yield number, lot_type, rng.choice(prices), payload, hash_content(payload)
+
+    def account_rows():
+        for number, lot_type, price, payload, content_hash in lot_rows(accounts, 0):
+            yield (
+                lot_type, rng.choice(LOT_FORMATS), f"{number:010d}.txt",
+                payload, content_hash, price, 'generator'
+            )
+
+    buyer_weights = zipf_weights(users, exponent=0.8)
+
+    def sell_log_rows():
+        for number, lot_type, price, payload, content_hash in lot_rows(sell_logs, accounts):
+            telegram_id = rng.choices(telegram_ids, cum_weights=buyer_weights)[0]
+            yield (
+                now - timedelta(seconds=rng.randint(0, 365 * 24 * 3600)), telegram_id,
+                f"User {telegram_id}", f"user{telegram_id}", lot_type,
+                f"{number:010d}.txt", payload, content_hash, str(price)
+            )
+
+    ensure_schema(engine, Base.metadata)
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        copied = copy_rows(
+            cursor, 'users',
+            ['telegram_id', 'name', 'username', 'balance', 'language',
+             'last_visit', 'is_ban', 'registration_date'],
+            user_rows(), batch_size)
+        print(f"users: {copied} rows, {time.monotonic() - started:.0f}s")
+
+        copied = copy_rows(
+            cursor, 'accounts',
+            ['lot_type', 'lot_format', 'filename', 'txt', 'content_hash', 'price', 'added_by'],
+            account_rows(), batch_size)
+        print(f"accounts: {copied} rows, {time.monotonic() - started:.0f}s")
+
+        copied = copy_rows(
+            cursor, 'sell_log',
+            ['time', 'telegram_id', 'name', 'username', 'type',
+             'filename', 'content', 'content_hash', 'price'],
+            sell_log_rows(), batch_size)
+        print(f"sell_log: {copied} rows, {time.monotonic() - started:.0f}s")
+
+        cursor.execute(PURCHASE_COUNT_BACKFILL)
+        connection.commit()
+        connection.autocommit = True
+        for table in ('users', 'accounts', 'sell_log', 'inventory_summary', 'inventory_delta'):
+            cursor.execute(f"ANALYZE {table}")
+    finally:
+        connection.close()
+    print(f"✅ Dataset generated in {time.monotonic() - started:.0f}s")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load a synthetic benchmark dataset with COPY')
+    parser.add_argument('--users', type=int, default=200_000)
+    parser.add_argument('--accounts', type=int, default=2_000_000)
+    parser.add_argument('--sell-logs', type=int, default=1_000_000)
+    parser.add_argument('--lot-types', type=int, default=40)
+    parser.add_argument('--payload-size', type=int, default=300, help='Mean payload size in bytes')
+    parser.add_argument('--batch-size', type=int, default=50_000, help='Rows per COPY statement')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    generate_dataset(
+        users=args.users,
+        accounts=args.accounts,
+        sell_logs=args.sell_logs,
+        lot_types=args.lot_types,
+        payload_size=args.payload_size,
+        batch_size=args.batch_size,
+        seed=args.seed
+    )
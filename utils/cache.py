@@ -1,9 +1,167 @@
 import json
+import time
+import itertools
+import asyncio
+import contextvars
+from typing import Any, Awaitable, Callable, Hashable
 from utils.logs import log
 import redis.asyncio as redis
+from redis.asyncio.cluster import RedisCluster
 from env import Config as config
 
 
+class CatalogCache:
+    """
+    In-process cache for catalog queries.
+
+    Values live for ttl seconds or until they are invalidated. Concurrent misses
+    for the same key share a single load (single-flight), so a burst of users
+    after an invalidation triggers one query instead of one per user.
+
+    Args:
+        ttl (float): Lifetime of a cached value in seconds.
+    """
+    def __init__(self, ttl: float) -> None:
+        self.ttl = ttl
+        self.values: dict[Hashable, tuple[float, Any]] = {}
+        self.loading: dict[Hashable, asyncio.Task] = {}
+        self.versions: dict[Hashable, int] = {}
+
+    async def get(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Returns the cached value for a key, loading it with loader on a miss.
+
+        Args:
+            key (Hashable): Cache key.
+            loader (Callable[[], Awaitable[Any]]): Coroutine function that loads the value.
+
+        Returns:
+            Any: The cached or freshly loaded value.
+        """
+        cached = self.values.get(key)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+
+        task = self.loading.get(key)
+        if task is None:
+            # The load is shared by all waiting callers, so it must not run
+            # in the context (e.g. the database session) of whichever came first
+            task = asyncio.get_running_loop().create_task(
+                self._load(key, loader), context=contextvars.Context())
+            self.loading[key] = task
+        # Shielded, so one caller being cancelled does not cancel the load for the others
+        return await asyncio.shield(task)
+
+    async def _load(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        version = self.versions.get(key, 0)
+        try:
+            value = await loader()
+            # Do not store a value that was loaded before an invalidation
+            if self.versions.get(key, 0) == version:
+                self.values[key] = (time.monotonic() + self.ttl, value)
+            return value
+        finally:
+            if self.loading.get(key) is asyncio.current_task():
+                del self.loading[key]
+
+    def invalidate(self, *keys: Hashable) -> None:
+        """
+        Drops cached values for the given keys. Loads that are already running
+        for these keys are not stored, the next caller starts a new load.
+        """
+        for key in keys:
+            self.values.pop(key, None)
+            self.loading.pop(key, None)
+            self.versions[key] = self.versions.get(key, 0) + 1
+        log.info(f"Catalog cache invalidated: {keys}")
+
+
+# Key layout, under the REDIS_PREFIX prefix:
+#   <prefix>:{u:<telegram_id>}:reservation  lots reserved by a user
+#   <prefix>:{u:<telegram_id>}:fsm:...      FSM state and data of a user, see utils.storage
+#   <prefix>:{lot:<filename>}               telegram_id of the holder of a lot
+#   <prefix>:{stock:<shard>}:counts         reserved lots per lot type, of the users of the shard
+#   <prefix>:{stock:<shard>}:lots           lot type of every counted held lot by its filename
+#   <prefix>:{stock:<shard>}:deadlines      deadlines of the held lots in ms
+# The keys of a user share the slot of the user, every lot hold has a slot of its own
+# and the reserved stock counters are split into REDIS_STOCK_SHARDS shards, the users
+# going to shard telegram_id % shards. So in a cluster the reservation traffic spreads
+# over the nodes, and the reserved stock is the sum of the shards.
+# Every script below touches the keys of one slot only, all passed in KEYS.
+
+# Shared by the scripts below: takes a held lot off the counters of a shard.
+# KEYS[1]: reserved stock, KEYS[2]: reserved lots, KEYS[3]: deadlines
+RELEASE_LOT = """
+local function release_lot(filename)
+    local lot_type = redis.call('HGET', KEYS[2], filename)
+    if lot_type then
+        redis.call('HDEL', KEYS[2], filename)
+        if redis.call('HINCRBY', KEYS[1], lot_type, -1) <= 0 then
+            redis.call('HDEL', KEYS[1], lot_type)
+        end
+    end
+    redis.call('ZREM', KEYS[3], filename)
+end
+"""
+
+# Releases the hold of a lot if it is still held by the user.
+# KEYS[1]: lot key
+# ARGV[1]: telegram_id
+# Returns 1 if the hold was released, else 0.
+UNHOLD_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# Counts held lots in the reserved stock of a shard until they are released or their hold expires.
+# KEYS[1..3]: reserved stock, lots and deadlines of the shard
+# ARGV[1]: TTL in ms, ARGV[2..]: pairs of a filename and its lot type
+COUNT_SCRIPT = """
+local time = redis.call('TIME')
+local deadline = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000) + tonumber(ARGV[1])
+for i = 2, #ARGV, 2 do
+    -- A lot whose expired hold is not swept yet is still counted
+    if redis.call('HSET', KEYS[2], ARGV[i], ARGV[i + 1]) == 1 then
+        redis.call('HINCRBY', KEYS[1], ARGV[i + 1], 1)
+    end
+    redis.call('ZADD', KEYS[3], deadline, ARGV[i])
+end
+"""
+
+# Takes released lots off the counters of a shard.
+# KEYS[1..3]: reserved stock, lots and deadlines of the shard
+# ARGV[1..]: filenames of the lots
+UNCOUNT_SCRIPT = RELEASE_LOT + """
+for _, filename in ipairs(ARGV) do
+    release_lot(filename)
+end
+"""
+
+# Takes up to ARGV[1] expired holds off the counters of a shard and returns their filenames.
+# KEYS[1..3]: reserved stock, lots and deadlines of the shard
+SWEEP_SCRIPT = RELEASE_LOT + """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local expired = redis.call('ZRANGEBYSCORE', KEYS[3], '-inf', now, 'LIMIT', 0, tonumber(ARGV[1]))
+for _, filename in ipairs(expired) do
+    release_lot(filename)
+end
+return expired
+"""
+
+# Expired holds taken off the counters per run of the sweep script
+SWEEP_BATCH = 1000
+
+
+def lot_reference(lot: dict) -> str:
+    """
+    Returns the compact JSON of a lot kept in a reservation: its id and filename.
+    """
+    return json.dumps({'id': lot['id'], 'filename': lot['filename']}, separators=(',', ':'))
+
+
 class RedisManager:
     """
     Constructor for RedisManager class.
@@ -15,6 +173,11 @@ class RedisManager:
         db (int, optional): Redis database number. Defaults to 0.
         decode_responses (bool, optional): If True,
         all responses will be decoded with utf-8. Defaults to True.
+        prefix (str, optional): Prefix of all keys. Defaults to config.redis_prefix.
+        cluster (bool, optional): If True, connects to a Redis Cluster through the node
+        at host and port. Defaults to config.redis_cluster, 0 or 1.
+        shards (int, optional): Number of shards of the reserved stock counters.
+        Defaults to config.redis_stock_shards.
     """
     def __init__(
         self,
@@ -22,15 +185,57 @@ class RedisManager:
         port=config.redis_port,
         expire=config.redis_expire,
         db=0,
-        decode_responses=True
+        decode_responses=True,
+        prefix=config.redis_prefix,
+        cluster=bool(int(config.redis_cluster or 0)),
+        shards=int(config.redis_stock_shards)
     ):
-        self.client = redis.Redis(
-            host=host,
-            port=port,
-            db=db,
-            decode_responses=decode_responses
-        )
+        if cluster:
+            # A cluster has a single database
+            self.client = RedisCluster(
+                host=host,
+                port=port,
+                decode_responses=decode_responses
+            )
+        else:
+            self.client = redis.Redis(
+                host=host,
+                port=port,
+                db=db,
+                decode_responses=decode_responses
+            )
         self.expire = expire
+        self.prefix = prefix
+        self.shards = shards
+        self.lot_prefix = f"{prefix}:{{lot:"
+        self.unhold_script = self.client.register_script(UNHOLD_SCRIPT)
+        self.count_script = self.client.register_script(COUNT_SCRIPT)
+        self.uncount_script = self.client.register_script(UNCOUNT_SCRIPT)
+        self.sweep_script = self.client.register_script(SWEEP_SCRIPT)
+
+    def stock_keys(self, shard: int) -> list[str]:
+        """
+        Returns the reserved stock, lots and deadlines keys of a shard, in the slot of the shard.
+        """
+        return [f"{self.prefix}:{{stock:{shard}}}:{name}" for name in ('counts', 'lots', 'deadlines')]
+
+    def user_stock_keys(self, telegram_id: int | str) -> list[str]:
+        """
+        Returns the keys of the shard that counts the lots reserved by a user.
+        """
+        return self.stock_keys(int(telegram_id) % self.shards)
+
+    def reservation_key(self, telegram_id: int | str) -> str:
+        """
+        Returns the key of the lots reserved by a user, in the slot of the user.
+        """
+        return f"{self.prefix}:{{u:{telegram_id}}}:reservation"
+
+    def lot_key(self, filename: str) -> str:
+        """
+        Returns the key that holds a lot for the user who reserved it.
+        """
+        return f"{self.lot_prefix}{filename}}}"
 
     async def connect(self):
         """
@@ -46,21 +251,82 @@ class RedisManager:
             log.error(f"❌ Error connection to Redis: {e}")
             raise
 
-    async def reserve_lots(self, telegram_id: int, lots: list[dict]) -> None:
+    async def hold_lots(self, telegram_id: int, lots: list[dict], quantity: int) -> list[dict]:
+        """
+        Holds up to quantity of the given lots for a user, in their order,
+        skipping lots held by other users. Each round tries the missing
+        number of lots in one pipeline.
+
+        Returns:
+            list[dict]: The held lots.
         """
-        Reserves lots for a given telegram_id.
+        held = []
+        pending = iter(lots)
+        while len(held) < quantity:
+            batch = list(itertools.islice(pending, quantity - len(held)))
+            if not batch:
+                break
+            pipe = self.client.pipeline(transaction=False)
+            for lot in batch:
+                pipe.set(self.lot_key(lot['filename']), telegram_id, nx=True, px=int(self.expire) * 1000)
+            held += [lot for lot, acquired in zip(batch, await pipe.execute()) if acquired]
+        return held
+
+    async def unhold_lots(self, telegram_id: int, filenames: list[str]) -> list[str]:
+        """
+        Releases the holds of the given lots that are still held by a user.
+
+        Returns:
+            list[str]: Filenames of the released lots.
+        """
+        released = await asyncio.gather(*(
+            self.unhold_script(keys=[self.lot_key(filename)], args=[telegram_id])
+            for filename in filenames
+        ))
+        return [filename for filename, done in zip(filenames, released) if done]
+
+    async def reserve_lots(self, telegram_id: int, lots: list[dict], quantity: int) -> list[dict]:
+        """
+        Reserves quantity of the given lots for a given telegram_id,
+        skipping lots held by other users. Either all quantity lots are reserved or none.
+        Replaces the previous reservation of the user.
+        The reservation only keeps the id and filename of the lots.
+
+        The keys involved live in different cluster slots, so this takes a few
+        round trips instead of one script. Each lot is held with SET NX, so two
+        users never hold the same lot, and the database claim stays the final check.
 
         Args:
             telegram_id (int): Telegram user ID.
-            lots (list[dict]): List of dictionaries with lot data.
+            lots (list[dict]): Candidate lots with their id, filename, lot_type and price,
+                cheapest first.
+            quantity (int): Number of lots to reserve.
 
         Returns:
-            None
+            list[dict]: The reserved candidates, empty if there were not enough free ones.
         """
-        value = json.dumps(lots)
-        await self.client.set(name=telegram_id, value=value, ex=self.expire)
-        log.info(f"ID: {telegram_id}| Reserved lots: {value}")
+        if quantity <= 0 or len(lots) < quantity:
+            return []
 
+        await self.release_reservation(telegram_id)
+        reserved = await self.hold_lots(telegram_id, lots, quantity)
+        if len(reserved) < quantity:
+            await self.unhold_lots(telegram_id, [lot['filename'] for lot in reserved])
+            log.info(f"ID: {telegram_id}| Not enough free lots to reserve {quantity}")
+            return []
+
+        ttl = int(self.expire) * 1000
+        await self.count_script(
+            keys=self.user_stock_keys(telegram_id),
+            args=[ttl, *(value for lot in reserved for value in (lot['filename'], lot['lot_type']))]
+        )
+        await self.client.set(
+            self.reservation_key(telegram_id),
+            '[' + ','.join(lot_reference(lot) for lot in reserved) + ']',
+            px=ttl
+        )
+        log.info(f"ID: {telegram_id}| Reserved {len(reserved)} lots")
+        return reserved
 
     async def get_reserved_by_user(self, telegram_id: int) -> list[dict]:
         """
@@ -70,60 +336,64 @@ class RedisManager:
             telegram_id (int): Telegram user ID.
 
         Returns:
-            list[dict]: List of dictionaries with lot data if found, else an empty list.
+            list[dict]: The id and filename of the reserved lots if found, else an empty list.
         """
-        raw = await self.client.get(telegram_id)
+        raw = await self.client.get(self.reservation_key(telegram_id))
         if raw:
-            log.info(f"ID: {telegram_id}| Get reserved lots by user: {raw}")
-            return json.loads(raw)
+            lots = json.loads(raw)
+            log.info(f"ID: {telegram_id}| Get {len(lots)} reserved lots by user")
+            return lots
         return []
 
-    async def get_all_reserved_by_types(self, telegram_id: str, type: str) -> list[str]:
+    async def get_reserved_stock(self) -> dict[str, int]:
         """
-        Retrieves all reserved lots for a given telegram_id and type.
-
-        Args:
-            telegram_id (str): Telegram user ID.
-            type (str): Type of the lot to retrieve.
+        Retrieves the number of lots reserved by all users per lot type,
+        the sum of the counters of all shards. One pipeline.
+        The counters are not keyed by price, so a price change does not strand
+        the holds taken before it. Expired holds are taken off the counters by
+        ReservationSweeper, within seconds of their expiry.
 
         Returns:
-            list[str]: List of strings with the type of the lot for the given
-                telegram_id and type if found, else an empty list.
+            dict[str, int]: Reserved quantity by lot type.
         """
+        pipe = self.client.pipeline(transaction=False)
+        for shard in range(self.shards):
+            pipe.hgetall(self.stock_keys(shard)[0])
+        stock = {}
+        for counts in await pipe.execute():
+            for lot_type, quantity in counts.items():
+                stock[lot_type] = stock.get(lot_type, 0) + int(quantity)
+        return stock
 
-        keys = await self.client.keys(f"{telegram_id}")
-        types = []
-        for key in keys:
-            raw = await self.client.get(key)
-            if raw:
-                lots = json.loads(raw)
-                types.extend({type: lot[type]} for lot in lots if type in lot)
-        return types
+    async def sweep_expired(self, shard: int, batch: int = SWEEP_BATCH) -> list[str]:
+        """
+        Takes up to batch expired holds off the reserved stock counters of a shard.
 
-    async def get_all_reserved_types(self, telegram_id: str) -> list[dict[str, str]]:
+        Returns:
+            list[str]: Filenames of the lots whose hold expired.
         """
-        Retrieves all reserved lot types for a given telegram_id.
+        return await self.sweep_script(keys=self.stock_keys(shard), args=[batch])
 
-        Args:
-            telegram_id (str): Telegram user ID.
+    async def release_reservation(self, telegram_id: int) -> int:
+        """
+        Deletes the reservation of a user and releases the lots they still hold.
 
         Returns:
-            list[dict[str, str]]: A list of dictionaries containing lot type data
-            associated with the given telegram_id. If no data is found, returns an
-            empty list.
+            int: Number of released lots.
         """
-        keys = await self.client.keys(f"{telegram_id}")
-        types = []
-        for key in keys:
-            raw = await self.client.get(key)
-            if raw:
-                lots = json.loads(raw)
-                types.extend(lots)
-        return types
+        raw = await self.client.get(self.reservation_key(telegram_id))
+        if not raw:
+            return 0
+        released = await self.unhold_lots(telegram_id, [lot['filename'] for lot in json.loads(raw)])
+        if released:
+            await self.uncount_script(keys=self.user_stock_keys(telegram_id), args=released)
+        await self.client.delete(self.reservation_key(telegram_id))
+        return len(released)
 
     async def clear_reserved(self, telegram_id: int) -> None:
         """
-        Clears all reserved lots for a given telegram_id from the Redis database.
+        Clears all reserved lots for a given telegram_id from the Redis database
+        and releases the lots they still hold.
 
         Args:
             telegram_id (int): Telegram user ID.
@@ -131,9 +401,112 @@ class RedisManager:
         Returns:
             None: This function does not return any value.
         """
-        keys = await self.client.keys(f"{telegram_id}")
-        if keys:
-            await self.client.delete(*keys)
-            log.info(f"ID: {telegram_id}| Cleared reserved lots.")
-        else:
-            log.info(f"ID: {telegram_id}| No reserved lots to clear.")
+        released = await self.release_reservation(telegram_id)
+        log.info(f"ID: {telegram_id}| Cleared reserved lots. Released: {released}")
+
+
+class ReservationSweeper:
+    """
+    Takes the holds of lapsed reservations off the reserved stock counters as soon
+    as they expire. It is the only place that sweeps expired holds. The database
+    needs no release, since a claim past its claimed_until already counts as free.
+
+    Listens to Redis keyspace notifications for expired keys, with a periodic
+    sweep of the deadlines as the fallback, e.g. when notifications cannot be
+    enabled or were missed.
+
+    Args:
+        manager (RedisManager): Redis manager that holds the reservations.
+        interval (float): Seconds between fallback sweeps.
+    """
+    def __init__(self, manager: RedisManager, interval: float) -> None:
+        self.manager = manager
+        self.interval = interval
+        self.expired = asyncio.Event()
+        self.tasks: list[asyncio.Task] = []
+
+    async def sweep(self) -> int:
+        """
+        Takes all expired holds off the counters of every shard, batch by batch.
+
+        Returns:
+            int: Number of released lots.
+        """
+        released = 0
+        for shard in range(self.manager.shards):
+            while True:
+                filenames = await self.manager.sweep_expired(shard)
+                released += len(filenames)
+                if len(filenames) < SWEEP_BATCH:
+                    break
+        if released:
+            log.info(f"Released {released} lots of expired reservations")
+        return released
+
+    async def enable_notifications(self) -> bool:
+        """
+        Enables the notifications of expired keys, keeping the other configured events.
+
+        Returns:
+            bool: True if the notifications are enabled.
+        """
+        client = self.manager.client
+        try:
+            events = (await client.config_get('notify-keyspace-events')).get('notify-keyspace-events', '')
+            if not ('E' in events and ('x' in events or 'A' in events)):
+                await client.config_set('notify-keyspace-events', events + ''.join(
+                    flag for flag in 'Ex' if flag not in events))
+            return True
+        except redis.ResponseError as e:
+            log.warning(f"Expired key notifications are not available, using the sweep only: {e}")
+            return False
+
+    async def listen(self) -> None:
+        """
+        Wakes the sweep up whenever the hold of a lot expires.
+        """
+        db = self.manager.client.connection_pool.connection_kwargs.get('db', 0)
+        pubsub = self.manager.client.pubsub()
+        await pubsub.subscribe(f"__keyevent@{db}__:expired")
+        try:
+            async for message in pubsub.listen():
+                # Holds expire together with the reservation they belong to
+                if message['type'] == 'message' and message['data'].startswith(self.manager.lot_prefix):
+                    self.expired.set()
+        finally:
+            await pubsub.aclose()
+
+    async def run(self) -> None:
+        """
+        Sweeps after expiry notifications, or every interval seconds without them.
+        """
+        while True:
+            try:
+                await asyncio.wait_for(self.expired.wait(), timeout=self.interval)
+                # Holds of a reservation expire together, let their notifications arrive
+                await asyncio.sleep(1)
+            except asyncio.TimeoutError:
+                pass
+            self.expired.clear()
+            try:
+                await self.sweep()
+            except Exception as e:
+                log.error(f"Failed to release expired reservations: {e}")
+
+    async def start(self) -> None:
+        """
+        Starts the sweep and, outside of a cluster, the expiry listener in the background.
+        Notifications are published by each cluster node separately, so a cluster relies on the sweep.
+        """
+        if not isinstance(self.manager.client, RedisCluster) and await self.enable_notifications():
+            self.tasks.append(asyncio.create_task(self.listen()))
+        self.tasks.append(asyncio.create_task(self.run()))
+
+    async def stop(self) -> None:
+        """
+        Stops the background tasks.
+        """
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks.clear()
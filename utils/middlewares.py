@@ -0,0 +1,54 @@
+"""
+This module contains middlewares for the dispatcher.
+"""
+
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.types import Update, Message, CallbackQuery
+from database.models import AsyncSessionLocal, current_session
+from database.db import UserDb
+
+
+class DbSessionMiddleware(BaseMiddleware):
+    """
+    Unit of work middleware. Opens one session per Telegram update and closes it
+    after the update is processed, so concurrent updates never share a session
+    or its identity map. The session only holds a pooled connection while a
+    database call runs, see session_scope.
+    """
+    async def on_pre_process_update(self, update: Update, data: dict) -> None:
+        """
+        Opens a session for the update and makes it current for the database classes.
+        """
+        session = AsyncSessionLocal()
+        data['db_session'] = session
+        data['db_session_token'] = current_session.set(session)
+
+    async def on_post_process_update(self, update: Update, result: list, data: dict) -> None:
+        """
+        Closes the session of the update. Uncommitted work is rolled back
+        and the connection is returned to the pool.
+        """
+        current_session.reset(data.pop('db_session_token'))
+        await data.pop('db_session').close()
+
+
+class ActivityMiddleware(BaseMiddleware):
+    """
+    Records every interaction of a user as a visit. The visits are written
+    in batches by the activity buffer, not one UPDATE per click.
+    """
+    def __init__(self, user: UserDb) -> None:
+        super().__init__()
+        self.user = user
+
+    async def on_pre_process_message(self, message: Message, data: dict) -> None:
+        """
+        Records a visit for a message.
+        """
+        self.user.refresh_user(obj=message)
+
+    async def on_pre_process_callback_query(self, callback: CallbackQuery, data: dict) -> None:
+        """
+        Records a visit for a callback query.
+        """
+        self.user.refresh_user(obj=callback)
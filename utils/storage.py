@@ -0,0 +1,142 @@
+"""
+This module contains the Redis-backed FSM storage.
+"""
+
+import json
+import typing
+import redis.asyncio as redis
+from aiogram.contrib.fsm_storage.redis import RedisStorage2, STATE_KEY, STATE_DATA_KEY
+
+
+# Sets the state of a user and gives its data the same TTL.
+# KEYS[1]: state key, KEYS[2]: data key
+# ARGV[1]: state, ARGV[2]: TTL in ms, 0 for none
+SET_STATE_SCRIPT = """
+local ttl = tonumber(ARGV[2])
+if ttl > 0 then
+    redis.call('SET', KEYS[1], ARGV[1], 'PX', ttl)
+    redis.call('PEXPIRE', KEYS[2], ttl)
+else
+    redis.call('SET', KEYS[1], ARGV[1])
+    redis.call('PERSIST', KEYS[2])
+end
+"""
+
+# Stores the data of a user and restarts the TTL of their state, so both expire together
+# and every step of a dialog gives the user the full TTL of the state again.
+# KEYS[1]: state key, KEYS[2]: data key
+# ARGV[1]: JSON of the data, ARGV[2]: default TTL in ms, 0 for none,
+# ARGV[3..]: pairs of a state name and its TTL in ms
+SET_DATA_SCRIPT = """
+local state = redis.call('GET', KEYS[1])
+local ttl = tonumber(ARGV[2])
+if state then
+    for i = 3, #ARGV, 2 do
+        if ARGV[i] == state then
+            ttl = tonumber(ARGV[i + 1])
+        end
+    end
+end
+if ttl > 0 then
+    redis.call('SET', KEYS[2], ARGV[1], 'PX', ttl)
+    if state then
+        redis.call('PEXPIRE', KEYS[1], ttl)
+    end
+else
+    redis.call('SET', KEYS[2], ARGV[1])
+end
+"""
+
+
+class StateRedisStorage(RedisStorage2):
+    """
+    FSM storage on the Redis client of RedisManager, shared by all bot instances.
+    State and data keys expire after the TTL of the current state, so abandoned
+    dialogs are cleaned up by Redis. Keys are tagged by user, <prefix>:{u:<user>}:fsm:...,
+    so the keys of a user, with their reservation, share a cluster slot and the scripts
+    below can touch them together.
+
+    Args:
+        client (redis.Redis): Redis client, e.g. RedisManager.client.
+        state_ttls (dict[str, int]): TTL in seconds by state name.
+        default_ttl (int | None, optional): TTL of other states and of data
+            without a state, None to keep them. Defaults to None.
+        prefix (str, optional): Key prefix, e.g. RedisManager.prefix. Defaults to 'shop'.
+    """
+    def __init__(
+            self,
+            client: redis.Redis,
+            state_ttls: dict[str, int],
+            default_ttl: int | None = None,
+            prefix: str = 'shop'
+        ) -> None:
+        # The client is shared, so RedisStorage2 does not create a pool of its own
+        self._redis = client
+        self._prefix = (prefix,)
+        self._state_ttl = default_ttl
+        self._data_ttl = default_ttl
+        self._bucket_ttl = default_ttl
+        self.state_ttls = state_ttls
+        self.set_state_script = client.register_script(SET_STATE_SCRIPT)
+        self.set_data_script = client.register_script(SET_DATA_SCRIPT)
+
+    def generate_key(self, chat, user, *parts) -> str:
+        """
+        Returns the key of a user in the slot of the user.
+        """
+        return ':'.join((self._prefix[0], f"{{u:{user}}}", 'fsm', str(chat), *map(str, parts)))
+
+    def get_ttl(self, state: str | None) -> int | None:
+        """
+        Returns the TTL of a state in seconds.
+        """
+        return self.state_ttls.get(state, self._state_ttl)
+
+    async def set_state(
+            self, *,
+            chat: typing.Union[str, int, None] = None,
+            user: typing.Union[str, int, None] = None,
+            state: typing.Optional[typing.AnyStr] = None
+        ) -> None:
+        """
+        Sets the state and gives the state and its data the TTL of the state.
+        """
+        chat, user = self.check_address(chat=chat, user=user)
+        state_key = self.generate_key(chat, user, STATE_KEY)
+        data_key = self.generate_key(chat, user, STATE_DATA_KEY)
+        if state is None:
+            await self._redis.delete(state_key)
+            return
+
+        state = self.resolve_state(state)
+        await self.set_state_script(
+            keys=[state_key, data_key], args=[state, (self.get_ttl(state) or 0) * 1000])
+
+    async def set_data(
+            self, *,
+            chat: typing.Union[str, int, None] = None,
+            user: typing.Union[str, int, None] = None,
+            data: typing.Dict = None
+        ) -> None:
+        """
+        Stores the data with the TTL of the current state and restarts the TTL of the state.
+        """
+        chat, user = self.check_address(chat=chat, user=user)
+        data_key = self.generate_key(chat, user, STATE_DATA_KEY)
+        if not data:
+            await self._redis.delete(data_key)
+            return
+
+        await self.set_data_script(
+            keys=[self.generate_key(chat, user, STATE_KEY), data_key],
+            args=[
+                json.dumps(data),
+                (self._data_ttl or 0) * 1000,
+                *(value for state, ttl in self.state_ttls.items() for value in (state, ttl * 1000))
+            ]
+        )
+
+    async def close(self) -> None:
+        """
+        Leaves the shared client open, it is closed by its owner.
+        """
@@ -36,6 +36,7 @@ class Strings:
     topup_exception = 'Ошибка при пополнении баланса'
     topup_success = 'Баланс пополнен на . Приятных покупок'
     redis_expire = 'Срок резерва истек.'
+    purchase_exception = 'Не удалось завершить покупку. Средства не списаны.'
     admin_panel = 'Панель администратора'
     admin_panel_desc = 'Привет, '
     admin_add_lots = 'Добавить товары'